@@ -0,0 +1,80 @@
+# Compare the vectorized detection.nms with the original sequential loop
+from __future__ import print_function
+import argparse
+import time
+import torch
+from detection import nms
+
+def nms_sequential(boxes, scores, overlap=0.5, top_k=200):
+    """The original per-box while-loop NMS, kept as the reference."""
+    keep = scores.new(scores.size(0)).zero_().long()
+    if boxes.numel() == 0:
+        return keep, 0
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+    area = torch.mul(x2 - x1, y2 - y1)
+    v, idx = scores.sort(0)
+    if top_k > 0:
+        idx = idx[-top_k:]
+    count = 0
+    while idx.numel() > 0:
+        i = idx[-1]
+        keep[count] = i
+        count += 1
+        if idx.size(0) == 1:
+            break
+        idx = idx[:-1]
+        xx1 = torch.clamp(torch.index_select(x1, 0, idx), min=x1[i])
+        yy1 = torch.clamp(torch.index_select(y1, 0, idx), min=y1[i])
+        xx2 = torch.clamp(torch.index_select(x2, 0, idx), max=x2[i])
+        yy2 = torch.clamp(torch.index_select(y2, 0, idx), max=y2[i])
+        w = torch.clamp(xx2 - xx1, min=0.0)
+        h = torch.clamp(yy2 - yy1, min=0.0)
+        inter = w*h
+        rem_areas = torch.index_select(area, 0, idx)
+        union = (rem_areas - inter) + area[i]
+        IoU = inter/union
+        idx = idx[IoU.le(overlap)]
+    return keep, count
+
+def random_boxes(num, device):
+    # clustered boxes, like the candidates of a dense detector
+    centers = torch.rand(max(num // 20, 1), 2, device=device)
+    cxcy = centers[torch.randint(0, centers.size(0), (num,), device=device)]
+    cxcy = cxcy + torch.randn(num, 2, device=device) * 0.02
+    wh = torch.rand(num, 2, device=device) * 0.1 + 0.02
+    boxes = torch.cat([cxcy - wh/2, cxcy + wh/2], 1)
+    scores = torch.rand(num, device=device)
+    return boxes, scores
+
+def timeit(fn, repeat, cuda):
+    fn()
+    if cuda:
+        torch.cuda.synchronize()
+    t0 = time.time()
+    for i in range(repeat):
+        result = fn()
+    if cuda:
+        torch.cuda.synchronize()
+    return (time.time() - t0) / repeat, result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark nms')
+    parser.add_argument('--sizes', default='200,1000,5000', type=str)
+    parser.add_argument('--overlap', default=0.45, type=float)
+    parser.add_argument('--repeat', default=10, type=int)
+    parser.add_argument('--cuda', action='store_true', help='enables cuda')
+    args = parser.parse_args()
+    print(args)
+
+    device = 'cuda' if args.cuda else 'cpu'
+    torch.manual_seed(0)
+    for num in [int(n) for n in args.sizes.split(',')]:
+        boxes, scores = random_boxes(num, device)
+        t_seq, (keep_seq, count_seq) = timeit(lambda: nms_sequential(boxes, scores, args.overlap, num), args.repeat, args.cuda)
+        t_vec, (keep_vec, count_vec) = timeit(lambda: nms(boxes, scores, args.overlap, num), args.repeat, args.cuda)
+        same = count_seq == count_vec and torch.equal(keep_seq[:count_seq], keep_vec[:count_vec])
+        print('%5d boxes  kept %4d  sequential: %8.3f ms  vectorized: %8.3f ms  speedup: %5.1fx  same: %s' %
+              (num, count_vec, t_seq*1000, t_vec*1000, t_seq/t_vec, same))
@@ -0,0 +1,199 @@
+# Compare the tokenizer based prototxt.parse_prototxt with the original
+# line based parser on generated multi-thousand-layer networks
+from __future__ import print_function
+import argparse
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from prototxt import parse_prototxt
+
+def parse_prototxt_lines(protofile):
+    """The original readline based parser, kept as the reference."""
+    def line_type(line):
+        if line.find(':') >= 0:
+            return 0
+        elif line.find('{') >= 0:
+            return 1
+        return -1
+
+    def parse_block(fp):
+        block = OrderedDict()
+        line = fp.readline().strip()
+        while line != '}':
+            ltype = line_type(line)
+            if ltype == 0: # key: value
+                line = line.split('#')[0]
+                key, value = line.split(':')
+                key = key.strip()
+                value = value.strip().strip('"')
+                if key in block:
+                    if type(block[key]) == list:
+                        block[key].append(value)
+                    else:
+                        block[key] = [block[key], value]
+                else:
+                    block[key] = value
+            elif ltype == 1: # blockname {
+                key = line.split('{')[0].strip()
+                sub_block = parse_block(fp)
+                block[key] = sub_block
+            line = fp.readline().strip()
+            line = line.split('#')[0]
+        return block
+
+    fp = open(protofile, 'r')
+    props = OrderedDict()
+    layers = []
+    line = fp.readline()
+    while line != '':
+        line = line.strip().split('#')[0]
+        if line == '':
+            line = fp.readline()
+            continue
+        ltype = line_type(line)
+        if ltype == 0: # key: value
+            key, value = line.split(':')
+            key = key.strip()
+            value = value.strip().strip('"')
+            if key in props:
+               if type(props[key]) == list:
+                   props[key].append(value)
+               else:
+                   props[key] = [props[key], value]
+            else:
+                props[key] = value
+        elif ltype == 1: # blockname {
+            key = line.split('{')[0].strip()
+            if key == 'layer':
+                layer = parse_block(fp)
+                layers.append(layer)
+            else:
+                props[key] = parse_block(fp)
+        line = fp.readline()
+    fp.close()
+
+    net_info = OrderedDict()
+    net_info['props'] = props
+    net_info['layers'] = layers
+    return net_info
+
+class NetWriter(object):
+    """Emit layers in the usual caffe prototxt layout."""
+    def __init__(self, name, size):
+        self.lines = ['name: "%s"' % name, 'input: "data"',
+                      'input_dim: 1', 'input_dim: 3', 'input_dim: %d' % size, 'input_dim: %d' % size]
+
+    def layer(self, name, ltype, bottoms, top, params=None):
+        lines = self.lines
+        lines.append('layer {')
+        lines.append('  name: "%s"' % name)
+        lines.append('  type: "%s"' % ltype)
+        for bottom in bottoms:
+            lines.append('  bottom: "%s"' % bottom)
+        lines.append('  top: "%s"' % top)
+        if params is not None:
+            key, values = params
+            lines.append('  %s {' % key)
+            for k, v in values:
+                lines.append('    %s: %s' % (k, v))
+            lines.append('  }')
+        lines.append('}')
+        return top
+
+    def bn_relu(self, name, bottom):
+        self.layer(name + '_bn', 'BatchNorm', [bottom], name + '_bn', ('batch_norm_param', [('use_global_stats', 'true')]))
+        self.layer(name + '_scale', 'Scale', [name + '_bn'], name + '_bn', ('scale_param', [('bias_term', 'true')]))
+        return self.layer(name + '_relu', 'ReLU', [name + '_bn'], name + '_bn')
+
+    def conv(self, name, bottom, num_output, kernel_size, stride=1):
+        # comments and trailing comments are part of real prototxts too
+        self.lines.append('# %s' % name)
+        return self.layer(name, 'Convolution', [bottom], name,
+                          ('convolution_param', [('num_output', num_output), ('kernel_size', kernel_size),
+                                                 ('pad', kernel_size // 2), ('stride', '%d  # stride' % stride),
+                                                 ('bias_term', 'false')]))
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+def resnet_prototxt(depth=1001):
+    """Pre-activation bottleneck ResNet for CIFAR, (depth-2)/9 blocks per stage."""
+    net = NetWriter('ResNet-%d' % depth, 32)
+    blocks = (depth - 2) // 9
+    top = net.conv('conv1', 'data', 16, 3)
+    for stage, width in enumerate([16, 32, 64]):
+        for block in range(blocks):
+            name = 'res%d_%d' % (stage + 1, block + 1)
+            stride = 2 if stage > 0 and block == 0 else 1
+            pre = net.bn_relu(name + '_pre', top)
+            branch = net.conv(name + '_conv1', pre, width, 1, stride)
+            branch = net.conv(name + '_conv2', net.bn_relu(name + '_conv1', branch), width, 3)
+            branch = net.conv(name + '_conv3', net.bn_relu(name + '_conv2', branch), width * 4, 1)
+            shortcut = top
+            if block == 0:
+                shortcut = net.conv(name + '_proj', pre, width * 4, 1, stride)
+            top = net.layer(name, 'Eltwise', [shortcut, branch], name, ('eltwise_param', [('operation', 'SUM')]))
+    top = net.bn_relu('post', top)
+    top = net.layer('pool', 'Pooling', [top], 'pool', ('pooling_param', [('pool', 'AVE'), ('kernel_size', 8), ('stride', 1)]))
+    net.layer('fc', 'InnerProduct', [top], 'fc', ('inner_product_param', [('num_output', 10)]))
+    return net.text()
+
+def densenet_prototxt(blocks=(6, 12, 64, 48), growth=32):
+    """DenseNet-BC, DenseNet-264 by default."""
+    net = NetWriter('DenseNet-%d' % (sum(blocks) * 2 + 5), 224)
+    top = net.conv('conv1', 'data', 64, 7, 2)
+    top = net.layer('pool1', 'Pooling', [net.bn_relu('conv1', top)], 'pool1',
+                    ('pooling_param', [('pool', 'MAX'), ('kernel_size', 3), ('stride', 2)]))
+    channels = 64
+    for b, num_layers in enumerate(blocks):
+        for l in range(num_layers):
+            name = 'conv%d_%d' % (b + 2, l + 1)
+            x = net.conv(name + '_x1', net.bn_relu(name + '_x1', top), growth * 4, 1)
+            x = net.conv(name + '_x2', net.bn_relu(name + '_x2', x), growth, 3)
+            top = net.layer('concat_%d_%d' % (b + 2, l + 1), 'Concat', [top, x], 'concat_%d_%d' % (b + 2, l + 1))
+            channels += growth
+        if b + 1 < len(blocks):
+            channels = channels // 2
+            name = 'conv%d_blk' % (b + 2)
+            top = net.conv(name, net.bn_relu(name, top), channels, 1)
+            top = net.layer('pool%d' % (b + 2), 'Pooling', [top], 'pool%d' % (b + 2),
+                            ('pooling_param', [('pool', 'AVE'), ('kernel_size', 2), ('stride', 2)]))
+    top = net.bn_relu('conv5_blk', top)
+    top = net.layer('pool5', 'Pooling', [top], 'pool5', ('pooling_param', [('pool', 'AVE'), ('kernel_size', 7), ('stride', 1)]))
+    net.layer('fc6', 'InnerProduct', [top], 'fc6', ('inner_product_param', [('num_output', 1000)]))
+    return net.text()
+
+def timeit(fn, repeat):
+    # best of repeat runs, parsing is short enough to be noisy
+    result = fn()
+    best = float('inf')
+    for i in range(repeat):
+        t0 = time.time()
+        fn()
+        best = min(best, time.time() - t0)
+    return best, result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark prototxt parsing')
+    parser.add_argument('--nets', default='resnet1001,densenet264', type=str)
+    parser.add_argument('--repeat', default=10, type=int)
+    args = parser.parse_args()
+    print(args)
+
+    generators = {'resnet1001': lambda: resnet_prototxt(1001),
+                  'resnet164': lambda: resnet_prototxt(164),
+                  'densenet264': lambda: densenet_prototxt((6, 12, 64, 48)),
+                  'densenet121': lambda: densenet_prototxt((6, 12, 24, 16))}
+    for name in args.nets.split(','):
+        text = generators[name]()
+        fd, protofile = tempfile.mkstemp(suffix='.prototxt')
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(text)
+        try:
+            t_old, net_old = timeit(lambda: parse_prototxt_lines(protofile), args.repeat)
+            t_new, net_new = timeit(lambda: parse_prototxt(protofile), args.repeat)
+        finally:
+            os.remove(protofile)
+        print('%-12s %5d layers %6d KB  line based: %8.2f ms  tokenizer: %8.2f ms  speedup: %4.1fx  same: %s' %
+              (name, len(net_new['layers']), len(text) // 1024, t_old*1000, t_new*1000, t_old/t_new, net_old == net_new))
@@ -1,19 +1,23 @@
 # 2017.12.16 by xiaohang
 from __future__ import print_function
 from __future__ import division
+import os
+import copy
+import hashlib
+import pickle
 import numpy as np
 import torch
 import torch.nn as nn
 from torch.nn.parameter import Parameter
 from torch.autograd import Variable
-from torch.autograd import Function
 import torch.nn.functional as F
 from collections import OrderedDict
+from functools import partial
 from prototxt import *
+from net_analysis import SKIPPED_TYPES, inplace_eltwise, layer_cost, prod
+from detection import Detection
 import caffe
 import caffe.proto.caffe_pb2 as caffe_pb2
-from torch.legacy.nn import SpatialCrossMapLRN as SpatialCrossMapLRNOld
-from itertools import product as product
 
 class FCView(nn.Module):
     def __init__(self):
@@ -27,76 +31,112 @@ class FCView(nn.Module):
         return 'view(nB, -1)'
 
 class Eltwise(nn.Module):
-    def __init__(self, operation='+'):
+    """Combine all inputs in one pass. A single output buffer is allocated
+    and the remaining inputs are accumulated into it; with inplace=True
+    (set by the execution plan when the first input is dead after this
+    layer) the first input itself is used as the buffer."""
+    def __init__(self, operation='+', coeffs=None):
         super(Eltwise, self).__init__()
         self.operation = operation
+        self.coeffs = coeffs
 
     def __repr__(self):
+        if self.coeffs is not None:
+            return 'Eltwise %s, coeffs=%s' % (self.operation, self.coeffs)
         return 'Eltwise %s' % self.operation
 
-    def forward(self, *inputs):
+    def forward(self, *inputs, inplace=False):
+        if torch.is_grad_enabled() and any(x.requires_grad for x in inputs):
+            inplace = False
         if self.operation == '+' or self.operation == 'SUM':
-            x = inputs[0]
-            for i in range(1,len(inputs)):
-                x = x + inputs[i]
-        elif self.operation == '*' or self.operation == 'MUL':
-            x = inputs[0]
-            for i in range(1,len(inputs)):
-                x = x * inputs[i]
+            coeffs = self.coeffs if self.coeffs is not None else [1.0] * len(inputs)
+            if inplace:
+                x = inputs[0]
+                if coeffs[0] != 1:
+                    x.mul_(coeffs[0])
+                start = 1
+            elif coeffs[0] != 1 or len(inputs) == 1:
+                x = inputs[0] * coeffs[0]
+                start = 1
+            else:
+                x = torch.add(inputs[0], inputs[1], alpha=coeffs[1])
+                start = 2
+            for i in range(start, len(inputs)):
+                x.add_(inputs[i], alpha=coeffs[i])
+            return x
+
+        if self.operation == '*' or self.operation == 'MUL' or self.operation == 'PROD':
+            op, op_ = torch.mul, 'mul_'
         elif self.operation == '/' or self.operation == 'DIV':
-            x = inputs[0]
-            for i in range(1,len(inputs)):
-                x = x / inputs[i]
+            op, op_ = torch.div, 'div_'
         elif self.operation == 'MAX':
-            x = inputs[0]
-            for i in range(1,len(inputs)):
-                x =torch.max(x, inputs[i])
+            op, op_ = torch.max, 'copy_'
         else:
             print('forward Eltwise, unknown operator')
+            return inputs[0]
+        if inplace:
+            x = inputs[0]
+            start = 1
+        elif len(inputs) == 1:
+            return inputs[0].clone()
+        else:
+            x = op(inputs[0], inputs[1])
+            start = 2
+        for i in range(start, len(inputs)):
+            if torch.is_grad_enabled() and (x.requires_grad or inputs[i].requires_grad):
+                x = op(x, inputs[i])
+            elif op_ == 'copy_':
+                torch.max(x, inputs[i], out=x)
+            else:
+                getattr(x, op_)(inputs[i])
         return x
 
 class Scale(nn.Module):
-    def __init__(self, channels):
+    """y = x * scale + bias, broadcast over the axes of x starting at axis.
+    scale is the learned weight of the given shape, or the second bottom
+    blob when weight_shape is None (e.g. SE-Net attention)."""
+    def __init__(self, weight_shape, axis=1, bias_shape=None):
         super(Scale, self).__init__()
-        self.weight = Parameter(torch.Tensor(channels))
-        self.bias = Parameter(torch.Tensor(channels))
-        self.channels = channels
+        if weight_shape is not None:
+            self.weight = Parameter(torch.empty(weight_shape))
+        else:
+            self.register_parameter('weight', None)
+        if bias_shape is not None:
+            self.bias = Parameter(torch.empty(bias_shape))
+        else:
+            self.register_parameter('bias', None)
+        self.axis = axis
 
     def __repr__(self):
-        return 'Scale(channels = %d)' % self.channels
-
-    def forward(self, x):
-        nB = x.size(0)
-        nC = x.size(1)
-        nH = x.size(2)
-        nW = x.size(3)
-        x = x * self.weight.view(1, nC, 1, 1).expand(nB, nC, nH, nW) + \
-            self.bias.view(1, nC, 1, 1).expand(nB, nC, nH, nW)
-        return x
+        weight_shape = list(self.weight.size()) if self.weight is not None else 'bottom[1]'
+        return 'Scale(shape=%s, axis=%d, bias_term=%s)' % (weight_shape, self.axis, self.bias is not None)
+
+    def forward(self, x, scale=None):
+        if scale is None:
+            scale = self.weight
+        axis = self.axis if self.axis >= 0 else self.axis + x.dim()
+        scale = scale.view(scale.size() + (1,) * (x.dim() - axis - scale.dim()))
+        if self.bias is None:
+            return x * scale
+        bias = self.bias.view(self.bias.size() + (1,) * (x.dim() - axis - self.bias.dim()))
+        return torch.addcmul(bias, x, scale)
 
 class Slice(nn.Module):
-   def __init__(self, axis, slice_points):
-       super(Slice, self).__init__()
-       self.axis = axis
-       self.slice_points = slice_points
+    """Split x along axis at slice_points, or into num_outputs equal parts
+    when no slice point is given. The outputs are views of x."""
+    def __init__(self, axis, slice_points, num_outputs):
+        super(Slice, self).__init__()
+        self.axis = axis
+        self.slice_points = slice_points
+        self.num_outputs = num_outputs
 
-   def __repr__(self):
+    def __repr__(self):
         return 'Slice(axis=%d, slice_points=%s)' % (self.axis, self.slice_points)
 
-   def forward(self, x):
-       prev = 0
-       outputs = []
-       is_cuda = x.data.is_cuda
-       if is_cuda: device_id = x.data.get_device()
-       for idx, slice_point in enumerate(self.slice_points):
-           rng = range(prev, slice_point)
-           rng = torch.LongTensor(rng)
-           if is_cuda: rng = rng.cuda(device_id)
-           rng = Variable(rng)
-           y = x.index_select(self.axis, rng)
-           prev = slice_point
-           outputs.append(y)
-       return tuple(outputs)
+    def forward(self, x):
+        if len(self.slice_points) == 0:
+            return torch.tensor_split(x, self.num_outputs, self.axis)
+        return torch.tensor_split(x, self.slice_points, self.axis)
 
 class Concat(nn.Module):
     def __init__(self, axis):
@@ -173,40 +213,35 @@ class Flatten(nn.Module):
             left_size = x.size(i) * left_size
         return x.view(left_size, -1).contiguous()
 
-# function interface, internal, do not use this one!!!
-class LRNFunc(Function):
-    def __init__(self, size, alpha=1e-4, beta=0.75, k=1):
-        super(LRNFunc, self).__init__()
-        self.size = size
-        self.alpha = alpha
-        self.beta = beta
-        self.k = k
-
-    def forward(self, input):
-        self.save_for_backward(input)
-        self.lrn = SpatialCrossMapLRNOld(self.size, self.alpha, self.beta, self.k)
-        self.lrn.type(input.type())
-        return self.lrn.forward(input)
-
-    def backward(self, grad_output):
-        input, = self.saved_tensors
-        return self.lrn.backward(input, grad_output)
-
-
-# use this one instead
 class LRN(nn.Module):
-    def __init__(self, size, alpha=1e-4, beta=0.75, k=1):
+    """Caffe local response normalization.
+    ACROSS_CHANNELS: y = x * (k + alpha/size * sum_{size channels} x^2)^-beta
+    WITHIN_CHANNEL:  y = x * (1 + alpha/size^2 * sum_{size x size} x^2)^-beta
+    The window sums are computed with average pooling over the squared
+    input, so the layer is fully vectorized and differentiable.
+    """
+    def __init__(self, size, alpha=1e-4, beta=0.75, k=1, norm_region='ACROSS_CHANNELS'):
         super(LRN, self).__init__()
         self.size = size
         self.alpha = alpha
         self.beta = beta
         self.k = k
+        self.norm_region = norm_region
 
     def __repr__(self):
-        return 'LRN(size=%d, alpha=%f, beta=%f, k=%d)' % (self.size, self.alpha, self.beta, self.k)
+        return 'LRN(size=%d, alpha=%f, beta=%f, k=%g, norm_region=%s)' % (self.size, self.alpha, self.beta, self.k, self.norm_region)
 
-    def forward(self, input):
-        return LRNFunc(self.size, self.alpha, self.beta, self.k)(input)
+    def forward(self, x):
+        pad = (self.size - 1) // 2
+        if self.norm_region == 'WITHIN_CHANNEL':
+            div = F.avg_pool2d(x * x, self.size, stride=1, padding=pad, count_include_pad=True)
+            div = div.mul(self.alpha).add(1.0)
+        else:
+            div = (x * x).unsqueeze(1)
+            div = F.pad(div, (0, 0, 0, 0, pad, self.size - 1 - pad))
+            div = F.avg_pool3d(div, (self.size, 1, 1), stride=1).squeeze(1)
+            div = div.mul(self.alpha).add(self.k)
+        return x * div.pow(-self.beta)
 
 class Reshape(nn.Module):
     def __init__(self, dims):
@@ -216,7 +251,10 @@ class Reshape(nn.Module):
     def __repr__(self):
         return 'Reshape(dims=%s)' % (self.dims)
 
-    def forward(self, x):
+    def forward(self, x, shape=None):
+        # the execution plan binds the target shape of its input shape
+        if shape is not None:
+            return x.view(shape)
         orig_dims = x.size()
         #assert(len(orig_dims) == len(self.dims))
         new_dims = [orig_dims[i] if self.dims[i] == 0 else self.dims[i] for i in range(len(self.dims))]
@@ -226,59 +264,191 @@ class Reshape(nn.Module):
 class PriorBox(nn.Module):
     """Compute priorbox coordinates in center-offset form for each source
     feature map.
-    Note:
-    This 'layer' has changed between versions of the original SSD
-    paper, so we include both versions, but note v2 is the most tested and most
-    recent version of the paper.
+    Follows the caffe SSD PriorBox layer: for every location one box per
+    min_size, one sqrt(min_size*max_size) box per max_size and one box per
+    extra aspect ratio (and its inverse with flip). Priors only depend on
+    the feature/image sizes, so they are computed with tensor ops once and
+    cached per (sizes, device, dtype), for the cache_size most recently
+    used keys.
     """
-    def __init__(self, min_size, clip, step, offset, variances):
+    def __init__(self, min_sizes, max_sizes, aspect_ratios, flip, clip, step_h, step_w, offset, variances, img_h=0, img_w=0):
         super(PriorBox, self).__init__()
-        self.min_size = min_size
+        self.min_sizes = min_sizes
+        self.max_sizes = max_sizes
+        self.aspect_ratios = [1.0]
+        for ar in aspect_ratios:
+            if any(abs(ar - a) < 1e-6 for a in self.aspect_ratios):
+                continue
+            self.aspect_ratios.append(ar)
+            if flip:
+                self.aspect_ratios.append(1.0/ar)
+        self.flip = flip
         self.clip = clip
-        self.step = step
+        self.step_h = step_h
+        self.step_w = step_w
         self.offset = offset
+        if len(variances) == 1:
+            variances = variances * 4
         self.variances = variances
+        self.img_h = img_h
+        self.img_w = img_w
+
+        box_widths = []
+        box_heights = []
+        for s, min_size in enumerate(min_sizes):
+            box_widths.append(min_size)
+            box_heights.append(min_size)
+            if len(max_sizes) > 0:
+                size = (min_size * max_sizes[s]) ** 0.5
+                box_widths.append(size)
+                box_heights.append(size)
+            for ar in self.aspect_ratios[1:]:
+                box_widths.append(min_size * ar ** 0.5)
+                box_heights.append(min_size / ar ** 0.5)
+        self.box_widths = box_widths
+        self.box_heights = box_heights
+        self.num_priors = len(box_widths)
+        self.cache = OrderedDict()
+        self.cache_size = 8
 
     def __repr__(self):
-        return 'PriorBox(min_size=%d, clip=%d, step=%d, offset=%f, variances=%s)' % (self.min_size, self.clip, self.step, self.offset, self.variances)
-        
+        return 'PriorBox(min_size=%s, max_size=%s, aspect_ratio=%s, clip=%d, step=(%g, %g), offset=%f, variances=%s)' % \
+            (self.min_sizes, self.max_sizes, self.aspect_ratios, self.clip, self.step_h, self.step_w, self.offset, self.variances)
+
     def forward(self, feature, image):
-        mean = []
-        #assert(feature.size(2) == feature.size(3))
-        #assert(image.size(2) == image.size(3))
         feature_height = feature.size(2)
         feature_width = feature.size(3)
-        image_height = image.size(2)
-        image_width = image.size(3)
-        #for i, j in product(range(feature_height), repeat=2):
-        for j in range(feature_height):
-            for i in range(feature_width):
-                # unit center x,y
-                cx = (i + self.offset) * self.step / image_width
-                cy = (j + self.offset) * self.step / image_height
-                ww = float(self.min_size)/image_width
-                hh = float(self.min_size)/image_height
-                mean += [cx-ww/2.0, cy-hh/2.0, cx+ww/2.0, cy+hh/2.0]
-
-        # back to torch land
-        output1 = torch.Tensor(mean).view(-1, 4)
-        output2 = torch.FloatTensor(self.variances).view(1,4).expand_as(output1)
+        image_height = self.img_h if self.img_h > 0 else image.size(2)
+        image_width = self.img_w if self.img_w > 0 else image.size(3)
+        key = (feature_height, feature_width, image_height, image_width, feature.device, feature.dtype)
+        output = self.cache.get(key)
+        if output is None:
+            output = self.create_priors(feature_height, feature_width, image_height, image_width, feature.device, feature.dtype)
+            self.cache[key] = output
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+        return output
+
+    def create_priors(self, feature_height, feature_width, image_height, image_width, device, dtype):
+        step_h = self.step_h if self.step_h > 0 else float(image_height) / feature_height
+        step_w = self.step_w if self.step_w > 0 else float(image_width) / feature_width
+        # unit center x,y: [H,1,1] and [1,W,1], box sizes: [1,1,K]
+        cy = (torch.arange(feature_height, device=device, dtype=dtype) + self.offset) * step_h
+        cx = (torch.arange(feature_width, device=device, dtype=dtype) + self.offset) * step_w
+        cy = cy.view(-1, 1, 1)
+        cx = cx.view(1, -1, 1)
+        half_w = torch.tensor(self.box_widths, device=device, dtype=dtype).view(1, 1, -1) / 2.0
+        half_h = torch.tensor(self.box_heights, device=device, dtype=dtype).view(1, 1, -1) / 2.0
+        size = (feature_height, feature_width, self.num_priors)
+        output1 = torch.stack([((cx - half_w) / image_width).expand(size),
+                               ((cy - half_h) / image_height).expand(size),
+                               ((cx + half_w) / image_width).expand(size),
+                               ((cy + half_h) / image_height).expand(size)], 3)
         if self.clip:
             output1.clamp_(max=1, min=0)
-        output1 = output1.view(1,1,-1)
-        output2 = output2.contiguous().view(1,1,-1)
-        output = torch.cat([output1, output2], 1)
-        if feature.data.is_cuda:
-            device_id = feature.data.get_device()
-            return Variable(output.cuda(device_id))
-        else:
-            return Variable(output)
+        output1 = output1.view(1, 1, -1)
+        output2 = torch.tensor(self.variances, device=device, dtype=dtype).view(1, 1, 4)
+        output2 = output2.expand(1, output1.size(2)//4, 4).contiguous().view(1, 1, -1)
+        return torch.cat([output1, output2], 1)
+
+def fc_linear(in_features, out_features):
+    return nn.Sequential(FCView(), nn.Linear(in_features, out_features))
+
+# module constructors by the builder name of the module specs
+LAYER_BUILDERS = {
+    'Conv2d': nn.Conv2d,
+    'BatchNorm2d': nn.BatchNorm2d,
+    'ReLU': nn.ReLU,
+    'LeakyReLU': nn.LeakyReLU,
+    'MaxPool2d': nn.MaxPool2d,
+    'AvgPool2d': nn.AvgPool2d,
+    'Linear': nn.Linear,
+    'FCLinear': fc_linear,
+    'Dropout': nn.Dropout,
+    'CrossEntropyLoss': nn.CrossEntropyLoss,
+    'Scale': Scale,
+    'Eltwise': Eltwise,
+    'Normalize': Normalize,
+    'LRN': LRN,
+    'Permute': Permute,
+    'Flatten': Flatten,
+    'Slice': Slice,
+    'Concat': Concat,
+    'PriorBox': PriorBox,
+    'Reshape': Reshape,
+    'Softmax': Softmax,
+    'Detection': Detection,
+}
+
+def build_modules(module_specs):
+    models = OrderedDict()
+    for lname, builder, args, kwargs in module_specs:
+        models[lname] = LAYER_BUILDERS[builder](*args, **kwargs)
+    return models
+
+# bump when the layer specs, module specs or net_info change
+NET_CACHE_VERSION = 6
+
+def net_cache_file(protofile, width, height, cache_dir):
+    """Cache file of a parsed network, keyed by the prototxt content, the
+    input size and the versions of the cache format and of torch."""
+    with open(protofile, 'rb') as fp:
+        content = fp.read()
+    key = hashlib.sha1(content)
+    key.update(repr((width, height, NET_CACHE_VERSION, torch.__version__)).encode())
+    return os.path.join(cache_dir, '%s.net.pkl' % key.hexdigest())
+
+def load_net_cache(cache_file):
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as fp:
+            return pickle.load(fp)
+    except Exception as e:
+        print('ignore broken network cache %s: %s' % (cache_file, e))
+        return None
+
+def save_net_cache(cache_file, cached):
+    cache_dir = os.path.dirname(cache_file)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # workers may start together, write to a temp file and rename
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(tmp_file, 'wb') as fp:
+        pickle.dump(cached, fp, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, cache_file)
 
 class CaffeNet(nn.Module):
-    def __init__(self, protofile, width=None, height=None):
+    def __init__(self, protofile, width=None, height=None, cache_dir=None):
+        """cache_dir optionally names a directory where the parsed network
+        (net_info, layer specs, module specs and blob shapes) is cached,
+        later networks of the same prototxt and input size are built from
+        it without parsing the prototxt again."""
         super(CaffeNet, self).__init__()
-        self.net_info = parse_prototxt(protofile)
-        self.models = self.create_network(self.net_info, width, height)
+        cached = None
+        if cache_dir is not None:
+            cache_file = net_cache_file(protofile, width, height, cache_dir)
+            cached = load_net_cache(cache_file)
+        if cached is None:
+            self.net_info = parse_prototxt(protofile)
+            self.layer_specs = decode_layers(self.net_info)
+            module_specs, self.blob_shapes = self.create_module_specs(self.layer_specs, self.net_info['props'],
+                                                                      width, height)
+            if cache_dir is not None:
+                save_net_cache(cache_file, {'net_info': self.net_info, 'layer_specs': self.layer_specs,
+                                            'module_specs': module_specs, 'blob_shapes': self.blob_shapes,
+                                            'width': self.width, 'height': self.height})
+        else:
+            print('load network from %s' % cache_file)
+            self.net_info = cached['net_info']
+            self.layer_specs = cached['layer_specs']
+            module_specs = cached['module_specs']
+            self.blob_shapes = cached['blob_shapes']
+            self.width = cached['width']
+            self.height = cached['height']
+        self.models = build_modules(module_specs)
         for name,model in self.models.items():
             self.add_module(name, model)
 
@@ -288,6 +458,9 @@ class CaffeNet(nn.Module):
             self.mean_file = self.net_info['props']['mean_file']
 
         self.blobs = None
+        self.lean = False
+        self.plan_cache_size = 8
+        self.build_plan()
 
     def set_mean_file(self, mean_file):
         if mean_file != "":
@@ -304,70 +477,313 @@ class CaffeNet(nn.Module):
             outputs.append(self.blobs[name])
         return outputs
 
-    def forward(self, data):
+    def set_memory_lean(self, lean):
+        """In memory-lean mode intermediate blobs are dropped as soon as their
+        last consumer has run and forward only returns the output blobs."""
+        self.lean = lean
+        self.exec_plans = OrderedDict()
+
+    def set_outputs(self, output_names):
+        if type(output_names) != list:
+            output_names = [output_names]
+        self.output_names = output_names
+        self.exec_plans = OrderedDict()
+
+    def build_plan(self):
+        """Compile the layer specs into a flat execution plan.
+
+        Every blob name is mapped to an integer slot once, so forward only
+        has to walk a list of (module, bottom_ids, top_ids, layer) tuples.
+        """
+        blob_ids = OrderedDict()
+        blob_ids['data'] = 0
+        plan = []
+        consumed = set()
+        for layer in self.layer_specs:
+            if layer.type in SKIPPED_TYPES:
+                continue
+            bids = tuple(blob_ids.setdefault(name, len(blob_ids)) for name in layer.bottom)
+            tids = tuple(blob_ids.setdefault(name, len(blob_ids)) for name in layer.top)
+            consumed.update(bids)
+            plan.append((self._modules[layer.name], bids, tids, layer))
+        self.blob_ids = blob_ids
+        self.blob_names = list(blob_ids.keys())
+        self.plan = plan
+        # like caffe, blobs nobody consumes are the outputs of the net
+        self.output_names = [name for name, bid in blob_ids.items() if bid not in consumed]
+        self.exec_plans = OrderedDict()
+
+    def bind_shapes(self, plan, input_shape):
+        """Specialize plan to an input shape.
+
+        The blob shapes are inferred step by step. InnerProduct layers are
+        checked to get the number of features they were built for, and
+        Reshape layers get their target shape bound, so forward does no
+        shape arithmetic. Everything else works at any input size.
+        """
+        shapes = {0: tuple(input_shape)}
+        bound = []
+        for module, bids, tids, layer in plan:
+            bottom_shapes = [shapes[bid] for bid in bids]
+            top_shapes = layer_cost(layer, bottom_shapes)[0]
+            if layer.type == 'InnerProduct':
+                shape = bottom_shapes[0]
+                linear = module[1] if type(module) == nn.Sequential else module
+                features = prod(shape[1:]) if type(module) == nn.Sequential else shape[-1]
+                if features != linear.in_features:
+                    raise ValueError('layer %s: input of shape %s has %d features, the layer was built for %d '
+                                     '(input %dx%d), InnerProduct layers fix the input size' %
+                                     (layer.name, 'x'.join(str(d) for d in shape), features,
+                                      linear.in_features, self.width, self.height))
+            elif layer.type == 'Reshape':
+                if prod(top_shapes[0]) != prod(bottom_shapes[0]) or min(top_shapes[0]) < 0:
+                    raise ValueError('layer %s: cannot reshape %s to dims %s' %
+                                     (layer.name, 'x'.join(str(d) for d in bottom_shapes[0]), list(layer.dims)))
+                module = partial(module, shape=top_shapes[0])
+            shapes.update(zip(tids, top_shapes))
+            bound.append((module, bids, tids, layer))
+        return bound
+
+    def needed_steps(self, output_names):
+        """The steps of the plan that output_names depend on, in order."""
+        needed = set(self.blob_ids[name] for name in output_names)
+        plan = []
+        for step in reversed(self.plan):
+            module, bids, tids, layer = step
+            if needed.isdisjoint(tids):
+                continue
+            needed.difference_update(tids)
+            needed.update(bids)
+            plan.append(step)
+        plan.reverse()
+        return plan
+
+    def compile_plan(self, output_names, input_shape=None):
+        """Build the steps needed to compute output_names.
+
+        Only the layers the outputs depend on are kept, specialized to
+        input_shape when given, see bind_shapes. Every kept step is
+        extended with the blob slots that die after it: a blob dies at the
+        last step that reads or writes it, unless it is one of the outputs.
+        Without memory-lean mode nothing is freed.
+        """
+        keep_ids = [self.blob_ids[name] for name in output_names]
+        plan = self.needed_steps(output_names)
+        if input_shape is not None:
+            plan = self.bind_shapes(plan, input_shape)
+        if not self.lean:
+            return [(module, bids, tids, ()) for module, bids, tids, layer in plan], keep_ids
+
+        last_use = dict()
+        for index, (module, bids, tids, layer) in enumerate(plan):
+            for bid in bids + tids:
+                last_use[bid] = index
+        for bid in keep_ids:
+            last_use.pop(bid, None)
+        frees = [[] for _ in plan]
+        for bid, index in last_use.items():
+            frees[index].append(bid)
+
+        # an Eltwise may accumulate into its first input when nothing
+        # else reads that storage afterwards
+        inplace = inplace_eltwise([layer for module, bids, tids, layer in plan], output_names)
+        steps = []
+        for index, ((module, bids, tids, layer), free) in enumerate(zip(plan, frees)):
+            if index in inplace:
+                module = partial(module, inplace=True)
+            steps.append((module, bids, tids, tuple(free)))
+        return steps, keep_ids
+
+    def forward(self, data, outputs=None):
+        """Run the network on data.
+
+        outputs optionally names the blobs wanted by the caller, only the
+        layers they depend on are executed. The input may have any size the
+        layers accept; compiled plans are cached per output set and input
+        shape, the plan_cache_size most recently used ones are kept.
+        """
         if self.has_mean:
-            nB = data.data.size(0)
-            nC = data.data.size(1)
-            nH = data.data.size(2)
-            nW = data.data.size(3)
-            data = data - Variable(self.mean_img.view(1, nC, nH, nW).expand(nB, nC, nH, nW))
-
-        self.blobs = OrderedDict()
-        self.blobs['data'] = data
-        
-        layers = self.net_info['layers']
-        layer_num = len(layers)
+            # the mean is per channel, it applies at any input size
+            data = data - Variable(self.mean_img[:, :1, :1].unsqueeze(0))
+
+        if outputs is None:
+            outputs = self.output_names
+        elif type(outputs) != list:
+            outputs = [outputs]
+        key = (tuple(outputs), tuple(data.size()))
+        exec_plan = self.exec_plans.get(key)
+        if exec_plan is None:
+            exec_plan = self.compile_plan(outputs, data.size())
+            self.exec_plans[key] = exec_plan
+            while len(self.exec_plans) > self.plan_cache_size:
+                self.exec_plans.popitem(last=False)
+        else:
+            self.exec_plans.move_to_end(key)
+        steps, keep_ids = exec_plan
+
+        blobs = [None] * len(self.blob_names)
+        blobs[0] = data
+        for module, bids, tids, frees in steps:
+            tdatas = module(*[blobs[i] for i in bids])
+            if len(tids) == 1:
+                blobs[tids[0]] = tdatas
+            else:
+                for tid, tdata in zip(tids, tdatas):
+                    blobs[tid] = tdata
+            for i in frees:
+                blobs[i] = None
+
+        if self.lean:
+            self.blobs = OrderedDict((self.blob_names[i], blobs[i]) for i in keep_ids)
+        else:
+            self.blobs = OrderedDict((name, blob) for name, blob in zip(self.blob_names, blobs) if blob is not None)
+        return self.blobs
+
+    def optimize_for_inference(self):
+        """Fold BatchNorm and Scale layers into the preceding Convolution.
+
+        Call this after load_weights. Convolution -> BatchNorm [-> Scale]
+        chains are merged into the convolution weight and bias, and the
+        BatchNorm/Scale layers are removed from the layer specs, net_info and
+        the plan. The folded network only computes the eval-mode result.
+        Outputs selected with set_outputs are kept, blobs among them are
+        never folded away.
+        """
+        layers = self.layer_specs
+        infos = self.net_info['layers']
+        output_names = self.output_names
+        readers = dict()
+        for layer in layers:
+            for name in layer.bottom:
+                readers[name] = readers.get(name, 0) + 1
+        # the selected outputs are read by the caller
+        for name in output_names:
+            readers[name] = readers.get(name, 0) + 1
+
+        def only_read_by_next(prev, layer):
+            # the blob prev writes must be consumed by layer alone, unless
+            # layer works in place and overwrites it anyway
+            return layer.bottom == prev.top and \
+                (layer.top == layer.bottom or readers[prev.top[0]] == 1)
+
+        folded = []
         i = 0
-        while i < layer_num:
-            layer = layers[i]
-            lname = layer['name']
-            ltype = layer['type']
-            tname = layer['top']
-            bname = layer['bottom']
-            bnames = bname if type(bname) == list else [bname]
-            tnames = tname if type(tname) == list else [tname]
-
-            if ltype in ['Data', 'Accuracy', 'SoftmaxWithLoss', 'Region']:
+        while i < len(layers) - 1:
+            conv = layers[i]
+            bn = layers[i+1]
+            if conv.type != 'Convolution' or bn.type != 'BatchNorm' or \
+               type(self.models[conv.name]) != nn.Conv2d or not only_read_by_next(conv, bn):
                 i = i + 1
+                continue
+            chain = [bn]
+            if i + 2 < len(layers):
+                scale = layers[i+2]
+                if scale.type == 'Scale' and len(scale.bottom) == 1 and only_read_by_next(bn, scale) \
+                   and self.models[scale.name].axis == 1 and self.models[scale.name].weight.dim() == 1:
+                    chain.append(scale)
+
+            conv_model = self.models[conv.name]
+            bn_model = self.models[bn.name]
+            weight = conv_model.weight.data
+            factor = (bn_model.running_var + bn_model.eps).rsqrt()
+            bias = -bn_model.running_mean * factor
+            if conv_model.bias is not None:
+                bias += conv_model.bias.data * factor
+            if len(chain) == 2:
+                scale_model = self.models[chain[1].name]
+                factor = factor * scale_model.weight.data
+                bias = bias * scale_model.weight.data
+                if scale_model.bias is not None:
+                    bias += scale_model.bias.data
+            weight.mul_(factor.view(-1, 1, 1, 1))
+            if conv_model.bias is None:
+                conv_model.bias = Parameter(bias.clone())
+                conv.bias_term = True
+                infos[i]['convolution_param']['bias_term'] = 'true'
             else:
-                bdatas = [self.blobs[name] for name in bnames]
-                tdatas = self._modules[lname](*bdatas)
-                if type(tdatas) != tuple:
-                    tdatas = (tdatas,)
-
-                assert(len(tdatas) == len(tnames))
-                for index, tdata in enumerate(tdatas):
-                    self.blobs[tnames[index]] = tdata
-                i = i + 1
-            input_size = self.blobs[bnames[0]].size()
-            output_size = self.blobs[tnames[0]].size()
-            print('forward %-30s %s -> %s' % (lname, list(input_size), list(output_size)))
+                conv_model.bias.data.copy_(bias)
+
+            conv.top = chain[-1].top
+            infos[i]['top'] = infos[i+len(chain)]['top']
+            for layer in chain:
+                print('fold %s into %s' % (layer.name, conv.name))
+                del self.models[layer.name]
+                del self._modules[layer.name]
+            del layers[i+1:i+1+len(chain)]
+            del infos[i+1:i+1+len(chain)]
+            folded.append(conv.name)
+            i = i + 1
+
+        self.build_plan()
+        self.output_names = output_names
+        return folded
+
+    def save_model(self, protofile, caffemodel=None, outputs=None):
+        """Export the network to a prototxt and optionally a caffemodel.
+
+        The current graph is written, also after optimize_for_inference or
+        pruning: layers come from net_info, num_output and bias_term follow
+        the modules and the input dims are the ones the network was built
+        for. With outputs only the layers these blobs depend on are
+        written. BatchNorm statistics are stored with a scale factor of 1.
+        """
+        names = None
+        if outputs is not None:
+            if type(outputs) != list:
+                outputs = [outputs]
+            names = set(layer.name for module, bids, tids, layer in self.needed_steps(outputs))
+
+        net_info = copy.deepcopy(self.net_info)
+        num, channels, _, _ = input_dims(net_info['props'])
+        set_input_dims(net_info['props'], [num, channels, self.height, self.width])
+        layers = []
+        weights = []
+        for layer, spec in zip(net_info['layers'], self.layer_specs):
+            if names is not None and spec.name not in names:
+                continue
+            layers.append(layer)
+            model = self.models.get(spec.name)
+            if spec.type == 'Convolution':
+                convolution_param = layer['convolution_param']
+                convolution_param['num_output'] = str(model.out_channels)
+                if model.bias is None:
+                    convolution_param['bias_term'] = 'false'
+                elif 'bias_term' in convolution_param:
+                    convolution_param['bias_term'] = 'true'
+                tensors = [model.weight] + ([model.bias] if model.bias is not None else [])
+            elif spec.type == 'InnerProduct':
+                linear = model[1] if type(model) == nn.Sequential else model
+                layer['inner_product_param']['num_output'] = str(linear.out_features)
+                tensors = [linear.weight] + ([linear.bias] if spec.bias_term else [])
+            elif spec.type == 'BatchNorm':
+                tensors = [model.running_mean, model.running_var, model.running_mean.new_ones(1)]
+            elif spec.type == 'Scale':
+                tensors = [t for t in (model.weight, model.bias) if t is not None]
+            elif spec.type == 'Normalize':
+                tensors = [model.weight]
+            else:
+                continue
+            weights.append((spec.name, spec.type, [t.data.cpu().numpy() for t in tensors]))
+        net_info['layers'] = layers
 
-        return self.blobs
-#        if type(self.outputs) == list:
-#            odatas = [blobs[name] for name in self.outputs]
-#            return odatas
-#        else:
-#            return blobs[self.outputs]
+        save_prototxt(net_info, protofile)
+        if caffemodel is not None:
+            save_caffemodel(weights, caffemodel)
 
     def print_network(self):
         print(self)
         print_prototxt(self.net_info)
 
-    def load_weights(self, caffemodel):
+    def load_weights(self, caffemodel, use_cache=False):
+        """Copy the blobs of caffemodel into the network parameters.
+        With use_cache the converted blobs are cached next to the caffemodel
+        and memory-mapped on later loads, see load_caffemodel_blobs."""
         if self.has_mean:
             print('mean_file', self.mean_file)
             mean_blob = caffe_pb2.BlobProto()
             mean_blob.ParseFromString(open(self.mean_file, 'rb').read())
 
-            if 'input_shape' in self.net_info['props']:
-                channels = int(self.net_info['props']['input_shape']['dim'][1])
-                height = int(self.net_info['props']['input_shape']['dim'][2])
-                width = int(self.net_info['props']['input_shape']['dim'][3])
-            else:
-                channels = int(self.net_info['props']['input_dim'][1])
-                height = int(self.net_info['props']['input_dim'][2])
-                width = int(self.net_info['props']['input_dim'][3])
+            _, channels, height, width = input_dims(self.net_info['props'])
 
             mu = np.array(mean_blob.data)
             mu.resize(channels, height, width)
@@ -377,93 +793,81 @@ class CaffeNet(nn.Module):
             self.register_buffer('mean_img', torch.zeros(channels, height, width))
             self.mean_img.copy_(mean_img)
 
-        model = parse_caffemodel(caffemodel)
-        layers = model.layer
-        if len(layers) == 0:
-            print('Using V1LayerParameter')
-            layers = model.layers
+        lmap = load_caffemodel_blobs(caffemodel, use_cache)
 
-        lmap = {}
-        for l in layers:
-            lmap[l.name] = l
+        def blob(lname, index, like):
+            return torch.from_numpy(lmap[lname][index]).view_as(like)
 
-        layers = self.net_info['layers']
+        layers = self.layer_specs
         layer_num = len(layers)
         i = 0
         while i < layer_num:
             layer = layers[i]
-            lname = layer['name']
-            ltype = layer['type']
+            lname = layer.name
+            ltype = layer.type
             if ltype == 'Convolution':
                 print('load weights %s' % lname)
-                convolution_param = layer['convolution_param']
-                bias = True
-                if 'bias_term' in convolution_param and convolution_param['bias_term'] == 'false':
-                    bias = False
-                #weight_blob = lmap[lname].blobs[0]
-                #print('caffe weight shape', weight_blob.num, weight_blob.channels, weight_blob.height, weight_blob.width)
-                caffe_weight = np.array(lmap[lname].blobs[0].data)
-                caffe_weight = torch.from_numpy(caffe_weight).view_as(self.models[lname].weight)
-                self.models[lname].weight.data.copy_(caffe_weight)
-                if bias and len(lmap[lname].blobs) > 1:
-                    self.models[lname].bias.data.copy_(torch.from_numpy(np.array(lmap[lname].blobs[1].data)))
-                    #print("convlution %s has bias" % lname)
+                self.models[lname].weight.data.copy_(blob(lname, 0, self.models[lname].weight))
+                if layer.bias_term and len(lmap[lname]) > 1:
+                    self.models[lname].bias.data.copy_(blob(lname, 1, self.models[lname].bias))
                 i = i + 1
             elif ltype == 'BatchNorm':
                 print('load weights %s' % lname)
-                self.models[lname].running_mean.copy_(torch.from_numpy(np.array(lmap[lname].blobs[0].data) / lmap[lname].blobs[2].data[0]))
-                self.models[lname].running_var.copy_(torch.from_numpy(np.array(lmap[lname].blobs[1].data) / lmap[lname].blobs[2].data[0]))
+                scale_factor = float(lmap[lname][2][0])
+                self.models[lname].running_mean.copy_(blob(lname, 0, self.models[lname].running_mean) / scale_factor)
+                self.models[lname].running_var.copy_(blob(lname, 1, self.models[lname].running_var) / scale_factor)
                 i = i + 1
             elif ltype == 'Scale':
                 print('load weights %s' % lname)
-                self.models[lname].weight.data.copy_(torch.from_numpy(np.array(lmap[lname].blobs[0].data)))
-                self.models[lname].bias.data.copy_(torch.from_numpy(np.array(lmap[lname].blobs[1].data)))
+                index = 0
+                if self.models[lname].weight is not None:
+                    self.models[lname].weight.data.copy_(blob(lname, 0, self.models[lname].weight))
+                    index = 1
+                if self.models[lname].bias is not None:
+                    self.models[lname].bias.data.copy_(blob(lname, index, self.models[lname].bias))
                 i = i + 1
             elif ltype == 'Normalize':
                 print('load weights %s' % lname)
-                self.models[lname].weight.data.copy_(torch.from_numpy(np.array(lmap[lname].blobs[0].data)))
+                self.models[lname].weight.data.copy_(blob(lname, 0, self.models[lname].weight))
                 i = i + 1
             elif ltype == 'InnerProduct':
                 print('load weights %s' % lname)
-                if type(self.models[lname]) == nn.Sequential:                    
-                    self.models[lname][1].weight.data.copy_(torch.from_numpy(np.array(lmap[lname].blobs[0].data)))
-                    if len(lmap[lname].blobs) > 1:
-                        self.models[lname][1].bias.data.copy_(torch.from_numpy(np.array(lmap[lname].blobs[1].data)))
+                if type(self.models[lname]) == nn.Sequential:
+                    linear = self.models[lname][1]
                 else:
-                    self.models[lname].weight.data.copy_(torch.from_numpy(np.array(lmap[lname].blobs[0].data)))
-                    if len(lmap[lname].blobs) > 1:
-                        self.models[lname].bias.data.copy_(torch.from_numpy(np.array(lmap[lname].blobs[1].data)))
+                    linear = self.models[lname]
+                linear.weight.data.copy_(blob(lname, 0, linear.weight))
+                if len(lmap[lname]) > 1:
+                    linear.bias.data.copy_(blob(lname, 1, linear.bias))
                 i = i + 1
-            elif ltype in ['Pooling', 'Eltwise', 'ReLU', 'Region', 'Permute', 'Flatten', 'Slice', 'Concat', 'Softmax', 'SoftmaxWithLoss', 'LRN', 'Dropout', 'Reshape', 'PriorBox']:
+            elif ltype in ['Pooling', 'Eltwise', 'ReLU', 'Region', 'Permute', 'Flatten', 'Slice', 'Concat', 'Softmax', 'SoftmaxWithLoss', 'LRN', 'Dropout', 'Reshape', 'PriorBox', 'DetectionOutput']:
                 i = i + 1
             else:
                 print('load_weights: unknown type %s' % ltype)
                 i = i + 1
 
     def create_network(self, net_info, input_width = None, input_height = None):
-        models = OrderedDict()
+        module_specs, self.blob_shapes = self.create_module_specs(decode_layers(net_info), net_info['props'],
+                                                                  input_width, input_height)
+        return build_modules(module_specs)
+
+    def create_module_specs(self, layer_specs, props, input_width = None, input_height = None):
+        """Walk the layers once, inferring the blob shapes.
+        Return:
+            the module specs (name, builder, args, kwargs) build_modules
+            creates the modules from, and {blob: (channels, height, width)}.
+        """
+        module_specs = []
+        def module_spec(builder, *args, **kwargs):
+            module_specs.append((lname, builder, args, kwargs))
+
         blob_channels = dict()
         blob_width = dict()
         blob_height = dict()
 
-        layers = net_info['layers']
-        props = net_info['props']
-        layer_num = len(layers)
-
-        if 'input_shape' in props:
-            blob_channels['data'] = int(props['input_shape']['dim'][1])
-            blob_height['data'] = int(props['input_shape']['dim'][2])
-            blob_width['data'] = int(props['input_shape']['dim'][3])
-
-            self.width = int(props['input_shape']['dim'][3])
-            self.height = int(props['input_shape']['dim'][2])
-        else:
-            blob_channels['data'] = int(props['input_dim'][1])
-            blob_height['data'] = int(props['input_dim'][2])
-            blob_width['data'] = int(props['input_dim'][3])
-
-            self.width = int(props['input_dim'][3])
-            self.height = int(props['input_dim'][2])
+        blob_num, blob_channels['data'], blob_height['data'], blob_width['data'] = input_dims(props)
+        self.width = blob_width['data']
+        self.height = blob_height['data']
 
         if input_width != None and input_height != None:
             blob_width['data'] = input_width
@@ -471,71 +875,65 @@ class CaffeNet(nn.Module):
             self.width = input_width
             self.height = input_height
 
-        i = 0
-        while i < layer_num:
-            layer = layers[i]
-            lname = layer['name']
-            ltype = layer['type']
+        for layer in layer_specs:
+            lname = layer.name
+            ltype = layer.type
             if ltype == 'Data':
-                i = i + 1
                 continue
-            bname = layer['bottom']
-            tname = layer['top']
+            bnames = layer.bottom
+            tnames = layer.top
+            bname = bnames[0]
+            tname = tnames[0]
             if ltype == 'Convolution':
-                convolution_param = layer['convolution_param']
                 channels = blob_channels[bname]
-                out_filters = int(convolution_param['num_output'])
-                kernel_size = int(convolution_param['kernel_size'])
-                stride = int(convolution_param['stride']) if 'stride' in convolution_param else 1
-                pad = int(convolution_param['pad']) if 'pad' in convolution_param else 0
-                group = int(convolution_param['group']) if 'group' in convolution_param else 1
-                bias = True
-                if 'bias_term' in convolution_param and convolution_param['bias_term'] == 'false':
-                    bias = False
-                models[lname] = nn.Conv2d(channels, out_filters, kernel_size, stride,pad,group, bias=bias)
-                blob_channels[tname] = out_filters
+                kernel_size = layer.kernel_size
+                stride = layer.stride
+                pad = layer.pad
+                module_spec('Conv2d', channels, layer.num_output, kernel_size, stride, pad, layer.group, bias=layer.bias_term)
+                blob_channels[tname] = layer.num_output
                 blob_width[tname] = (blob_width[bname] + 2*pad - kernel_size)//stride + 1
                 blob_height[tname] = (blob_height[bname] + 2*pad - kernel_size)//stride + 1
-                i = i + 1
             elif ltype == 'BatchNorm':
-                momentum = 0.9
-                if 'batch_norm_param' in layer and 'moving_average_fraction' in layer['batch_norm_param']:
-                    momentum = float(layer['batch_norm_param']['moving_average_fraction'])
                 channels = blob_channels[bname]
-                models[lname] = nn.BatchNorm2d(channels, momentum=momentum, affine=False)
+                module_spec('BatchNorm2d', channels, eps=layer.eps, momentum=layer.moving_average_fraction, affine=False)
                 blob_channels[tname] = channels
                 blob_width[tname] = blob_width[bname]
                 blob_height[tname] = blob_height[bname]
-                i = i + 1
             elif ltype == 'Scale':
-                channels = blob_channels[bname]
-                models[lname] = Scale(channels)
-                blob_channels[tname] = channels
+                num_axes = layer.num_axes
+                shape = [1, blob_channels[bname], blob_height[bname], blob_width[bname]]
+                axis = layer.axis % len(shape)
+                if len(bnames) == 2:
+                    # the scale is the second bottom, like caffe's BiasLayer a learned
+                    # bias has its shape, batch included
+                    bias_shape = None
+                    if layer.bias_term:
+                        bias_shape = [blob_num, blob_channels[bnames[1]], blob_height[bnames[1]],
+                                      blob_width[bnames[1]]]
+                    module_spec('Scale', None, layer.axis, bias_shape)
+                else:
+                    weight_shape = shape[axis:] if num_axes == -1 else shape[axis:axis+num_axes]
+                    module_spec('Scale', weight_shape, layer.axis, weight_shape if layer.bias_term else None)
+                blob_channels[tname] = blob_channels[bname]
                 blob_width[tname] = blob_width[bname]
                 blob_height[tname] = blob_height[bname]
-                i = i + 1
             elif ltype == 'ReLU':
                 inplace = (bname == tname)
-                if 'relu_param' in layer and 'negative_slope' in layer['relu_param']:
-                    negative_slope = float(layer['relu_param']['negative_slope'])
-                    models[lname] = nn.LeakyReLU(negative_slope=negative_slope, inplace=inplace)
+                if layer.negative_slope is not None:
+                    module_spec('LeakyReLU', negative_slope=layer.negative_slope, inplace=inplace)
                 else:
-                    models[lname] = nn.ReLU(inplace=inplace)
+                    module_spec('ReLU', inplace=inplace)
                 blob_channels[tname] = blob_channels[bname]
                 blob_width[tname] = blob_width[bname]
                 blob_height[tname] = blob_height[bname]
-                i = i + 1
             elif ltype == 'Pooling':
-                kernel_size = int(layer['pooling_param']['kernel_size'])
-                stride = int(layer['pooling_param']['stride'])
-                padding = 0
-                if 'pad' in layer['pooling_param']:
-                    padding = int(layer['pooling_param']['pad'])
-                pool_type = layer['pooling_param']['pool']
-                if pool_type == 'MAX':
-                    models[lname] = nn.MaxPool2d(kernel_size, stride, padding=padding, ceil_mode=True)
-                elif pool_type == 'AVE':
-                    models[lname] = nn.AvgPool2d(kernel_size, stride, padding=padding, ceil_mode=True)
+                kernel_size = layer.kernel_size
+                stride = layer.stride
+                padding = layer.pad
+                if layer.pool == 'MAX':
+                    module_spec('MaxPool2d', kernel_size, stride, padding=padding, ceil_mode=True)
+                elif layer.pool == 'AVE':
+                    module_spec('AvgPool2d', kernel_size, stride, padding=padding, ceil_mode=True)
 
                 if stride > 1:
                     blob_width[tname] = (blob_width[bname] + 2*padding - kernel_size + 1)//stride + 1
@@ -544,153 +942,122 @@ class CaffeNet(nn.Module):
                     blob_width[tname] = blob_width[bname] + 2*padding - kernel_size + 1
                     blob_height[tname] = blob_height[bname] + 2*padding - kernel_size + 1
                 blob_channels[tname] = blob_channels[bname]
-                i = i + 1
             elif ltype == 'Eltwise':
-                operation = 'SUM'
-                if 'eltwise_param' in layer and 'operation' in layer['eltwise_param']:
-                    operation = layer['eltwise_param']['operation']
-                bname0 = bname[0]
-                bname1 = bname[1]
-                models[lname] = Eltwise(operation)
-                blob_channels[tname] = blob_channels[bname0]
-                blob_width[tname] = blob_width[bname0]
-                blob_height[tname] = blob_height[bname0]
-                i = i + 1
+                coeffs = layer.coeff
+                if coeffs is not None:
+                    coeffs = list(coeffs)
+                    assert(len(coeffs) == len(bnames))
+                module_spec('Eltwise', layer.operation, coeffs)
+                blob_channels[tname] = blob_channels[bname]
+                blob_width[tname] = blob_width[bname]
+                blob_height[tname] = blob_height[bname]
             elif ltype == 'InnerProduct':
-                filters = int(layer['inner_product_param']['num_output'])
+                filters = layer.num_output
                 if blob_width[bname] != -1 or blob_height[bname] != -1:
                     channels = int(blob_channels[bname] * blob_width[bname] * blob_height[bname])
-                    models[lname] = nn.Sequential(FCView(), nn.Linear(channels, filters))
+                    module_spec('FCLinear', channels, filters)
                 else:
                     channels = blob_channels[bname]
-                    models[lname] = nn.Linear(channels, filters)
+                    module_spec('Linear', channels, filters)
                 blob_channels[tname] = filters
                 blob_width[tname] = 1
                 blob_height[tname] = 1
-                i = i + 1
             elif ltype == 'Dropout':
-                channels = blob_channels[bname]
-                dropout_ratio = float(layer['dropout_param']['dropout_ratio'])
-                models[lname] = nn.Dropout(dropout_ratio, inplace=True)
+                module_spec('Dropout', layer.dropout_ratio, inplace=True)
                 blob_channels[tname] = blob_channels[bname]
                 blob_width[tname] = blob_width[bname]
                 blob_height[tname] = blob_height[bname]
-                i = i + 1
             elif ltype == 'Normalize':
                 channels = blob_channels[bname]
-                scale = float(layer['norm_param']['scale_filler']['value'])
-                models[lname] = Normalize(channels, scale)
+                module_spec('Normalize', channels, layer.scale)
                 blob_channels[tname] = blob_channels[bname]
                 blob_width[tname] = blob_width[bname]
                 blob_height[tname] = blob_height[bname]
-                i = i + 1
             elif ltype == 'LRN':
-                local_size = int(layer['lrn_param']['local_size'])
-                alpha = float(layer['lrn_param']['alpha'])
-                beta = float(layer['lrn_param']['beta'])
-                models[lname] = LRN(local_size, alpha, beta)
+                module_spec('LRN', layer.local_size, layer.alpha, layer.beta, layer.k, layer.norm_region)
                 blob_channels[tname] = blob_channels[bname]
                 blob_width[tname] = blob_width[bname]
                 blob_height[tname] = blob_height[bname]
-                i = i + 1
             elif ltype == 'Permute':
-                orders = layer['permute_param']['order']
-                order0 = int(orders[0])
-                order1 = int(orders[1])
-                order2 = int(orders[2])
-                order3 = int(orders[3])
-                models[lname] = Permute(order0, order1, order2, order3)
+                order0, order1, order2, order3 = layer.order
+                module_spec('Permute', order0, order1, order2, order3)
                 shape = [1, blob_channels[bname], blob_height[bname], blob_width[bname]]
                 blob_channels[tname] = shape[order1]
                 blob_height[tname] = shape[order2]
                 blob_width[tname] = shape[order3]
-                i = i + 1
             elif ltype == 'Flatten':
-                axis = int(layer['flatten_param']['axis'])
-                models[lname] = Flatten(axis)
+                module_spec('Flatten', layer.axis)
                 blob_channels[tname] = blob_channels[bname] * blob_width[bname] * blob_height[bname]
                 blob_width[tname] = 1
                 blob_height[tname] = 1
-                i = i + 1
             elif ltype == 'Slice':
-                axis = int(layer['slice_param']['axis'])
-                assert(axis == 1)
-                assert(type(tname) == list)
-                slice_points = layer['slice_param']['slice_point']
-                assert(type(slice_points) == list)
-                assert(len(slice_points) == len(tname) - 1)
-                slice_points = [int(s) for s in slice_points]
+                axis = layer.axis
+                slice_points = list(layer.slice_point)
+                assert(len(slice_points) == 0 or len(slice_points) == len(tnames) - 1)
+                module_spec('Slice', axis, slice_points, len(tnames))
                 shape = [1, blob_channels[bname], blob_height[bname], blob_width[bname]]
-                slice_points.append(shape[axis])
-                models[lname] = Slice(axis, slice_points)
+                axis = axis % len(shape)
+                if len(slice_points) == 0:
+                    slice_points = [shape[axis] * (idx+1) // len(tnames) for idx in range(len(tnames))]
+                else:
+                    slice_points = slice_points + [shape[axis]]
                 prev = 0
-                for idx, tn in enumerate(tname):
-                    blob_channels[tn] = slice_points[idx] - prev
-                    blob_width[tn] = blob_width[bname]
-                    blob_height[tn] = blob_height[bname]
+                for idx, tn in enumerate(tnames):
+                    out_shape = list(shape)
+                    out_shape[axis] = slice_points[idx] - prev
+                    blob_channels[tn] = out_shape[1]
+                    blob_height[tn] = out_shape[2]
+                    blob_width[tn] = out_shape[3]
                     prev = slice_points[idx]
-                i = i + 1
             elif ltype == 'Concat':
-                axis = 1
-                if 'concat_param' in layer and 'axis' in layer['concat_param']:
-                    axis = int(layer['concat_param']['axis'])
-                models[lname] = Concat(axis)  
+                axis = layer.axis
+                module_spec('Concat', axis)
                 if axis == 1:
                     blob_channels[tname] = 0
-                    for bn in bname:
+                    for bn in bnames:
                         blob_channels[tname] += blob_channels[bn]
                         blob_width[tname] = blob_width[bn]
                         blob_height[tname] = blob_height[bn]
                 elif axis == 2:
-                    blob_channels[tname] = blob_channels[bname[0]]
+                    blob_channels[tname] = blob_channels[bname]
                     blob_width[tname] = 1
                     blob_height[tname] = 0
-                    for bn in bname:
+                    for bn in bnames:
                         blob_height[tname] += blob_height[bn]
-                i = i + 1
             elif ltype == 'PriorBox':
-                min_size = int(layer['prior_box_param']['min_size'])
-                clip = (layer['prior_box_param']['clip'] == 'true')
-                step = int(layer['prior_box_param']['step'])
-                offset = float(layer['prior_box_param']['offset'])
-                variances = layer['prior_box_param']['variance']
-                variances = [float(v) for v in variances]
-                models[lname] = PriorBox(min_size, clip, step, offset, variances)
+                module_spec('PriorBox', list(layer.min_size), list(layer.max_size), list(layer.aspect_ratio),
+                            layer.flip, layer.clip, layer.step_h, layer.step_w, layer.offset,
+                            list(layer.variance), layer.img_h, layer.img_w)
                 blob_channels[tname] = 1
                 blob_width[tname] = 1
                 blob_height[tname] = 1
-                i = i + 1
             elif ltype == 'Reshape':
-                reshape_dims = layer['reshape_param']['shape']['dim']
-                reshape_dims = [int(item) for item in reshape_dims]
-                models[lname] = Reshape(reshape_dims)
+                module_spec('Reshape', list(layer.dims))
                 blob_channels[tname] = 1
                 blob_width[tname] = 1
                 blob_height[tname] = 1
-                i = i + 1
             elif ltype == 'Softmax':
-                axis = 1
-                if 'softmax_param' in layer and 'axis' in layer['softmax_param']:
-                    axis = int(layer['softmax_param']['axis'])
-                models[lname] = Softmax(axis)
+                module_spec('Softmax', layer.axis)
                 blob_channels[tname] = blob_channels[bname]
                 blob_width[tname] = 1
                 blob_height[tname] = 1
-                i = i + 1
+            elif ltype == 'DetectionOutput':
+                module_spec('Detection', layer.num_classes, layer.background_label_id, layer.top_k,
+                            layer.confidence_threshold, layer.nms_threshold, layer.keep_top_k)
+                blob_channels[tname] = 1
+                blob_width[tname] = 7
+                blob_height[tname] = 1
             elif ltype == 'SoftmaxWithLoss':
-                models[lname] = nn.CrossEntropyLoss()
+                module_spec('CrossEntropyLoss')
                 blob_channels[tname] = 1
                 blob_width[tname] = 1
                 blob_height[tname] = 1
-                i = i + 1
             else:
                 print('create_network: unknown type #%s#' % ltype)
-                i = i + 1
-            input_width = blob_width[bname] if type(bname) != list else blob_width[bname[0]]
-            input_height = blob_height[bname] if type(bname) != list else blob_height[bname[0]]
-            output_width = blob_width[tname] if type(tname) != list else blob_width[tname[0]]
-            output_height = blob_height[tname] if type(tname) != list else blob_height[tname[0]]
-            print('create %-30s (%4d x %4d) -> (%4d x %4d)' % (lname, input_width, input_height, output_width, output_height))
+            print('create %-30s (%4d x %4d) -> (%4d x %4d)' % (lname, blob_width[bname], blob_height[bname],
+                                                                blob_width[tname], blob_height[tname]))
 
-        return models
+        blob_shapes = OrderedDict((name, (blob_channels[name], blob_height[name], blob_width[name]))
+                                  for name in blob_channels)
+        return module_specs, blob_shapes
       
@@ -30,24 +30,21 @@ def center_size(boxes):
 
 
 def intersect(box_a, box_b):
-    """ We resize both tensors to [A,B,2] without new malloc:
-    [A,2] -> [A,1,2] -> [A,B,2]
-    [B,2] -> [1,B,2] -> [A,B,2]
+    """ We broadcast every coordinate to [A,B] without new malloc of [A,B,2]:
+    [A] -> [A,1], [B] -> [1,B]
     Then we compute the area of intersect between box_a and box_b.
+    Leading batch dims are broadcast as well.
     Args:
-      box_a: (tensor) bounding boxes, Shape: [A,4].
-      box_b: (tensor) bounding boxes, Shape: [B,4].
+      box_a: (tensor) bounding boxes, Shape: [...,A,4].
+      box_b: (tensor) bounding boxes, Shape: [...,B,4].
     Return:
-      (tensor) intersection area, Shape: [A,B].
+      (tensor) intersection area, Shape: [...,A,B].
     """
-    A = box_a.size(0)
-    B = box_b.size(0)
-    max_xy = torch.min(box_a[:, 2:].unsqueeze(1).expand(A, B, 2),
-                       box_b[:, 2:].unsqueeze(0).expand(A, B, 2))
-    min_xy = torch.max(box_a[:, :2].unsqueeze(1).expand(A, B, 2),
-                       box_b[:, :2].unsqueeze(0).expand(A, B, 2))
-    inter = torch.clamp((max_xy - min_xy), min=0)
-    return inter[:, :, 0] * inter[:, :, 1]
+    inter_w = torch.min(box_a[..., :, None, 2], box_b[..., None, :, 2]).sub_(
+              torch.max(box_a[..., :, None, 0], box_b[..., None, :, 0]))
+    inter_h = torch.min(box_a[..., :, None, 3], box_b[..., None, :, 3]).sub_(
+              torch.max(box_a[..., :, None, 1], box_b[..., None, :, 1]))
+    return inter_w.clamp_(min=0).mul_(inter_h.clamp_(min=0))
 
 
 def jaccard(box_a, box_b):
@@ -57,18 +54,53 @@ def jaccard(box_a, box_b):
     E.g.:
         A ∩ B / A ∪ B = A ∩ B / (area(A) + area(B) - A ∩ B)
     Args:
-        box_a: (tensor) Ground truth bounding boxes, Shape: [num_objects,4]
-        box_b: (tensor) Prior boxes from priorbox layers, Shape: [num_priors,4]
+        box_a: (tensor) Ground truth bounding boxes, Shape: [...,num_objects,4]
+        box_b: (tensor) Prior boxes from priorbox layers, Shape: [...,num_priors,4]
     Return:
-        jaccard overlap: (tensor) Shape: [box_a.size(0), box_b.size(0)]
+        jaccard overlap: (tensor) Shape: [...,box_a.size(-2), box_b.size(-2)]
     """
     inter = intersect(box_a, box_b)
-    area_a = ((box_a[:, 2]-box_a[:, 0]) *
-              (box_a[:, 3]-box_a[:, 1])).unsqueeze(1).expand_as(inter)  # [A,B]
-    area_b = ((box_b[:, 2]-box_b[:, 0]) *
-              (box_b[:, 3]-box_b[:, 1])).unsqueeze(0).expand_as(inter)  # [A,B]
-    union = area_a + area_b - inter
-    return inter / union  # [A,B]
+    area_a = ((box_a[..., 2]-box_a[..., 0]) *
+              (box_a[..., 3]-box_a[..., 1])).unsqueeze(-1)  # [A,1]
+    area_b = ((box_b[..., 2]-box_b[..., 0]) *
+              (box_b[..., 3]-box_b[..., 1])).unsqueeze(-2)  # [1,B]
+    union = (area_a + area_b).sub_(inter)
+    return inter.div_(union)  # [A,B]
+
+
+def jaccard_reduce(box_a, box_b, valid=None, tile_size=4096):
+    """Reduce the jaccard overlap of two sets of boxes to the best match of
+    every box on either side, without building the whole [A,B] matrix.
+    box_b is processed in tiles of tile_size boxes, so the temporaries are
+    bounded by [...,A,tile_size]. Ties keep the lowest index, as max does.
+    Args:
+        box_a: (tensor) Ground truth bounding boxes, Shape: [...,A,4]
+        box_b: (tensor) Prior boxes from priorbox layers, Shape: [B,4]
+        valid: (tensor) Mask of boxes in box_a to consider, Shape: [...,A].
+            Masked boxes get an overlap of -1.
+        tile_size: (int) Number of boxes of box_b per tile.
+    Return:
+        best overlap and index in box_b for every box_a, Shape: [...,A]
+        best overlap and index in box_a for every box_b, Shape: [...,B]
+    """
+    best_b_overlap = best_b_idx = None
+    best_a_overlap, best_a_idx = [], []
+    for start in range(0, box_b.size(0), tile_size):
+        overlaps = jaccard(box_a, box_b[start:start+tile_size])
+        if valid is not None:
+            overlaps.masked_fill_(~valid[..., None], -1)
+        overlap, idx = overlaps.max(-2)
+        best_a_overlap.append(overlap)
+        best_a_idx.append(idx)
+        overlap, idx = overlaps.max(-1)
+        if best_b_overlap is None:
+            best_b_overlap, best_b_idx = overlap, idx
+        else:
+            better = overlap > best_b_overlap
+            best_b_overlap = torch.where(better, overlap, best_b_overlap)
+            best_b_idx = torch.where(better, idx + start, best_b_idx)
+    return (best_b_overlap, best_b_idx), \
+           (torch.cat(best_a_overlap, -1), torch.cat(best_a_idx, -1))
 
 
 def match(threshold, truths, priors, variances, labels, loc_t, conf_t, idx):
@@ -88,34 +120,56 @@ def match(threshold, truths, priors, variances, labels, loc_t, conf_t, idx):
     Return:
         The matched indices corresponding to 1)location and 2)confidence preds.
     """
-    # jaccard index
-    overlaps = jaccard(
-        truths,
-        point_form(priors)
-    )
-    # (Bipartite Matching)
-    # [1,num_objects] best prior for each ground truth
-    best_prior_overlap, best_prior_idx = overlaps.max(1)
-    # [1,num_priors] best ground truth for each prior
-    best_truth_overlap, best_truth_idx = overlaps.max(0)
-    best_truth_idx.squeeze_(0)
-    best_truth_overlap.squeeze_(0)
-
-    #best_prior_idx.squeeze_(1)
-    #best_prior_overlap.squeeze_(1)
-    #best_truth_overlap.index_fill_(0, best_prior_idx, 2)  # ensure best prior
-    # TODO refactor: index  best_prior_idx with long tensor
-    # ensure every gt matches with its prior of max overlap
-    for j in range(best_prior_idx.size(0)):
-        best_truth_idx[best_prior_idx[j]] = j
-        best_truth_overlap[best_prior_idx[j]] = best_prior_overlap[j]
-
-    matches = truths[best_truth_idx]          # Shape: [num_priors,4]
-    conf = labels[best_truth_idx]         # Shape: [num_priors]
+    valid = torch.ones(1, truths.size(0), dtype=torch.bool, device=truths.device)
+    loc, conf = match_batch(threshold, truths[None], valid, priors,
+                            point_form(priors), variances, labels[None])
+    loc_t[idx] = loc[0]    # [num_priors,4] encoded offsets to learn
+    conf_t[idx] = conf[0]  # [num_priors] top class label for each prior
+
+
+def match_batch(threshold, truths, valid, priors, priors_point, variances, labels,
+                max_overlaps=1 << 21):
+    """Batched version of match. Ground truths of a batch are padded to the
+    same number of objects, padding rows are masked out by valid.
+    Args:
+        threshold: (float) The overlap threshold used when mathing boxes.
+        truths: (tensor) Ground truth boxes, Shape: [batch,num_obj,4].
+        valid: (tensor) Mask of real (non padding) objects, Shape: [batch,num_obj].
+        priors: (tensor) Prior boxes in center-offset form, Shape: [num_priors,4].
+        priors_point: (tensor) The same priors in point form, Shape: [num_priors,4].
+        variances: (list[float]) Variances of priorboxes
+        labels: (tensor) Class labels of the objects, Shape: [batch,num_obj].
+        max_overlaps: (int) Priors are matched in tiles of about this many
+            overlaps, which bounds the memory of the overlap matrix.
+    Return:
+        loc_t: (tensor) encoded location targets, Shape: [batch,num_priors,4]
+        conf_t: (tensor) matched class labels, Shape: [batch,num_priors]
+    """
+    num, num_objs = valid.size()
+    # best prior for each ground truth and best ground truth for each prior,
+    # padding never wins a prior
+    tile_size = max(1, max_overlaps // (num * num_objs))
+    (best_prior_overlap, best_prior_idx), (best_truth_overlap, best_truth_idx) = \
+        jaccard_reduce(truths, priors_point, valid, tile_size)
+
+    # ensure every gt matches with its prior of max overlap. When several
+    # gts share a best prior the last one wins, as in the sequential loop.
+    later = (best_prior_idx[:, :, None] == best_prior_idx[:, None, :]) & \
+            valid[:, None, :] & \
+            torch.ones(num_objs, num_objs, dtype=torch.bool,
+                       device=valid.device).triu_(1)
+    bi, ji = (valid & ~later.any(2)).nonzero(as_tuple=True)
+    pi = best_prior_idx[bi, ji]
+    best_truth_idx[bi, pi] = ji
+    best_truth_overlap[bi, pi] = best_prior_overlap[bi, ji]
+
+    # Shape: [batch,num_priors,4]
+    matches = truths.gather(1, best_truth_idx[:, :, None].expand(num, -1, 4))
+    conf = labels.long().gather(1, best_truth_idx)  # Shape: [batch,num_priors]
     conf[best_truth_overlap < threshold] = 0  # label as background
     loc = encode(matches, priors, variances)
-    loc_t[idx] = loc    # [num_priors,4] encoded offsets to learn
-    conf_t[idx] = conf  # [num_priors] top class label for each prior
+    loc[~valid.any(1)] = 0  # images without objects have nothing to encode
+    return loc, conf
 
 
 def encode(matched, priors, variances):
@@ -123,23 +177,23 @@ def encode(matched, priors, variances):
     we have matched (based on jaccard overlap) with the prior boxes.
     Args:
         matched: (tensor) Coords of ground truth for each prior in point-form
-            Shape: [num_priors, 4].
+            Shape: [...,num_priors, 4].
         priors: (tensor) Prior boxes in center-offset form
             Shape: [num_priors,4].
         variances: (list[float]) Variances of priorboxes
     Return:
-        encoded boxes (tensor), Shape: [num_priors, 4]
+        encoded boxes (tensor), Shape: [...,num_priors, 4]
     """
 
     # dist b/t match center and prior's center
-    g_cxcy = (matched[:, :2] + matched[:, 2:])/2 - priors[:, :2]
+    g_cxcy = (matched[..., :2] + matched[..., 2:])/2 - priors[:, :2]
     # encode variance
     g_cxcy /= (variances[0] * priors[:, 2:])
     # match wh / prior wh
-    g_wh = (matched[:, 2:] - matched[:, :2]) / priors[:, 2:]
+    g_wh = (matched[..., 2:] - matched[..., :2]) / priors[:, 2:]
     g_wh = torch.log(g_wh) / variances[1]
     # return target for smooth_l1_loss
-    return torch.cat([g_cxcy, g_wh], 1)  # [num_priors,4]
+    return torch.cat([g_cxcy, g_wh], -1)  # [...,num_priors,4]
 
 
 # Adapted from https://github.com/Hakuyume/chainer-ssd
@@ -148,7 +202,7 @@ def decode(loc, priors, variances):
     the encoding we did for offset regression at train time.
     Args:
         loc (tensor): location predictions for loc layers,
-            Shape: [num_priors,4]
+            Shape: [num_priors,4] or [batch,num_priors,4]
         priors (tensor): Prior boxes in center-offset form.
             Shape: [num_priors,4].
         variances: (list[float]) Variances of priorboxes
@@ -157,10 +211,10 @@ def decode(loc, priors, variances):
     """
 
     boxes = torch.cat((
-        priors[:, :2] + loc[:, :2] * variances[0] * priors[:, 2:],
-        priors[:, 2:] * torch.exp(loc[:, 2:] * variances[1])), 1)
-    boxes[:, :2] -= boxes[:, 2:] / 2
-    boxes[:, 2:] += boxes[:, :2]
+        priors[..., :2] + loc[..., :2] * variances[0] * priors[..., 2:],
+        priors[..., 2:] * torch.exp(loc[..., 2:] * variances[1])), -1)
+    boxes[..., :2] -= boxes[..., 2:] / 2
+    boxes[..., 2:] += boxes[..., :2]
     return boxes
 
 
@@ -175,9 +229,85 @@ def log_sum_exp(x):
     return torch.log(torch.sum(torch.exp(x-x_max), 1)) + x_max
 
 
-# Original author: Francisco Massa:
-# https://github.com/fmassa/object-detection.torch
-# Ported to PyTorch by Max deGroot (02/01/2017)
+def nms_sorted(boxes, valid, overlap=0.5, block_size=256):
+    """Greedy non-maximum suppression of groups of score-sorted boxes.
+    Greedy NMS is evaluated on IoU matrices instead of looping over the
+    boxes one by one: a box is kept iff no kept box of its group with a
+    higher score overlaps it by more than overlap. The candidates are
+    processed in blocks. A block is first suppressed by the boxes kept so
+    far in one IoU computation. Then the rule is iterated inside the block,
+    starting from "keep all". A box only depends on higher scored boxes, so
+    this settles after as many rounds as the longest suppression chain in
+    the block. All groups are processed together.
+    Args:
+        boxes: (tensor) Boxes sorted by descending score, Shape: [groups,num,4].
+        valid: (tensor) Mask of the real (not padding) boxes, Shape: [groups,num].
+        overlap: (float) The overlap thresh for suppressing unnecessary boxes.
+        block_size: (int) Number of candidates resolved together.
+    Return:
+        (tensor) Mask of the kept boxes, Shape: [groups,num].
+    """
+    kept = valid.clone()
+    for start in range(0, boxes.size(1), block_size):
+        block = boxes[:, start:start+block_size]
+        alive = valid[:, start:start+block_size].to(boxes.dtype)
+        if start > 0:
+            if boxes.size(0) == 1:
+                prev = jaccard(boxes[0, :start][kept[0, :start]], block[0]).gt(overlap).any(0, keepdim=True)
+            else:
+                prev = (jaccard(boxes[:, :start], block).gt(overlap) & kept[:, :start].unsqueeze(2)).any(1)
+            alive = alive * prev.logical_not().to(boxes.dtype)
+        # suppress[g, i, j] = 1 if the higher scored box i overlaps box j too much
+        suppress = jaccard(block, block).gt_(overlap).triu_(1)
+        block_kept = alive
+        while True:
+            new_kept = torch.bmm(block_kept.unsqueeze(1), suppress).squeeze(1).eq(0).to(boxes.dtype) * alive
+            if torch.equal(new_kept, block_kept):
+                break
+            block_kept = new_kept
+        kept[:, start:start+block_size] = block_kept.bool()
+    return kept
+
+
+def batched_nms(boxes, scores, labels, overlap=0.5, top_k=200):
+    """Class-aware non-maximum suppression of all classes in one call.
+    The candidates are grouped by label into a padded [classes, top_k]
+    layout and suppressed together by nms_sorted, so boxes only suppress
+    boxes of their own class and no IoU is computed across classes.
+    Args:
+        boxes: (tensor) Shape: [num_boxes,4].
+        scores: (tensor) Shape: [num_boxes].
+        labels: (tensor) class of every box, Shape: [num_boxes].
+        overlap: (float) The overlap thresh for suppressing unnecessary boxes.
+        top_k: (int) The Maximum number of box preds to consider per class.
+    Return:
+        The indices of the kept boxes, in descending score order, and the
+        number of kept boxes.
+    """
+    if boxes.numel() == 0:
+        return labels.new(0).long(), 0
+    v, order = scores.sort(0)  # sort in ascending order
+    order = order.flip(0)
+    order = order[labels[order].sort(stable=True)[1]]
+    group_labels, counts = torch.unique_consecutive(labels[order], return_counts=True)
+    num = counts.max().item()
+    if top_k > 0:
+        num = min(num, top_k)
+    # rank of every candidate inside its class
+    starts = counts.cumsum(0) - counts
+    group = torch.arange(counts.size(0), device=counts.device).repeat_interleave(counts)
+    rank = torch.arange(order.size(0), device=counts.device) - starts.repeat_interleave(counts)
+    sel = rank < num
+    padded = order.new_full((counts.size(0), num), -1)
+    padded[group[sel], rank[sel]] = order[sel]
+    valid = padded.ge(0)
+    kept = nms_sorted(boxes[padded.clamp(min=0)], valid, overlap)
+    ids = padded[kept]
+    if counts.size(0) > 1:
+        ids = ids[scores[ids].sort(dim=0, descending=True, stable=True)[1]]
+    return ids, ids.size(0)
+
+
 def nms(boxes, scores, overlap=0.5, top_k=200):
     """Apply non-maximum suppression at test time to avoid detecting too many
     overlapping bounding boxes for a given object.
@@ -187,63 +317,19 @@ def nms(boxes, scores, overlap=0.5, top_k=200):
         overlap: (float) The overlap thresh for suppressing unnecessary boxes.
         top_k: (int) The Maximum number of box preds to consider.
     Return:
-        The indices of the kept boxes with respect to num_priors.
+        The indices of the kept boxes with respect to num_priors, in
+        descending score order, and the number of kept boxes.
     """
 
     keep = scores.new(scores.size(0)).zero_().long()
     if boxes.numel() == 0:
-        return keep
-    x1 = boxes[:, 0]
-    y1 = boxes[:, 1]
-    x2 = boxes[:, 2]
-    y2 = boxes[:, 3]
-    area = torch.mul(x2 - x1, y2 - y1)
-    v, idx = scores.sort(0)  # sort in ascending order
-    # I = I[v >= 0.01]
-    idx = idx[-top_k:]  # indices of the top-k largest vals
-    xx1 = boxes.new()
-    yy1 = boxes.new()
-    xx2 = boxes.new()
-    yy2 = boxes.new()
-    w = boxes.new()
-    h = boxes.new()
-
-    # keep = torch.Tensor()
-    count = 0
-    while idx.numel() > 0:
-        i = idx[-1]  # index of current largest val
-        # keep.append(i)
-        keep[count] = i
-        count += 1
-        if idx.size(0) == 1:
-            break
-        idx = idx[:-1]  # remove kept element from view
-        # load bboxes of next highest vals
-        torch.index_select(x1, 0, idx, out=xx1)
-        torch.index_select(y1, 0, idx, out=yy1)
-        torch.index_select(x2, 0, idx, out=xx2)
-        torch.index_select(y2, 0, idx, out=yy2)
-        # store element-wise max with next highest score
-        xx1 = torch.clamp(xx1, min=x1[i])
-        yy1 = torch.clamp(yy1, min=y1[i])
-        xx2 = torch.clamp(xx2, max=x2[i])
-        yy2 = torch.clamp(yy2, max=y2[i])
-        w.resize_as_(xx2)
-        h.resize_as_(yy2)
-        w = xx2 - xx1
-        h = yy2 - yy1
-        # check sizes of xx1 and xx2.. after each iteration
-        w = torch.clamp(w, min=0.0)
-        h = torch.clamp(h, min=0.0)
-        inter = w*h
-        # IoU = i / (area(a) + area(b) - i)
-        rem_areas = torch.index_select(area, 0, idx)  # load remaining areas)
-        union = (rem_areas - inter) + area[i]
-        IoU = inter/union  # store result in iou
-        # keep only elements with an IoU <= overlap
-        idx = idx[IoU.le(overlap)]
+        return keep, 0
+    labels = keep.new_zeros(scores.size(0))
+    ids, count = batched_nms(boxes, scores, labels, overlap, top_k)
+    keep[:count] = ids
     return keep, count
 
+
 def clip_boxes(boxes):
     boxes = torch.clamp(boxes, min = 0.0, max = 1.0)
     return boxes
@@ -267,6 +353,10 @@ class Detection(nn.Module):
         self.keep_top_k = keep_top_k
         self.variance = [0.1, 0.2]
 
+    def __repr__(self):
+        return 'Detection(num_classes=%d, top_k=%d, conf_thresh=%f, nms_thresh=%f, keep_top_k=%d)' % \
+            (self.num_classes, self.top_k, self.conf_thresh, self.nms_thresh, self.keep_top_k)
+
     def forward(self, loc, conf, prior):
         """
         Args:
@@ -276,80 +366,56 @@ class Detection(nn.Module):
                 Shape: [batch, num_priors*num_classes]
             prior: (tensor) Prior boxes and variances from priorbox layers
                 Shape: [1,2, num_priors*4]
+        Return:
+            (tensor) Shape: [1,1,num_det,7], one row per detection laid out
+            as caffe's [image_id, label, score, xmin, ymin, xmax, ymax].
+            When no image has a detection, every image gets one row of -1
+            with its image_id.
         """
         num = loc.size(0)
-        loc_data = loc.data
-        conf_data = conf.data
-        prior_data = prior.data
-
-        num_classes = self.num_classes
-        num_priors = prior_data.size(2)/4
-        if num == 1:
-            # size batch x num_classes x num_priors
-            conf_preds = conf_data.view(num_priors, self.num_classes).t().contiguous().unsqueeze(0)
-        else:
-            conf_preds = conf_data.view(num, num_priors,
-                                        self.num_classes).transpose(2, 1)
-
-        # Decode predictions into bboxes.
-        assert(num == 1)
-        if num_classes == 2:
-            loc_data = loc_data[0].view(-1, 4).clone()
-            prior_data = center_size(prior_data[0][0].view(-1,4).clone())
-            decoded_boxes = decode(loc_data, prior_data, self.variance)
-            #decoded_boxes = clip_boxes(decoded_boxes)
-            
-            # For each class, perform nms
-            conf_scores = conf_preds[0].clone()
-            num_det = 0
-            cl = 1
-            c_mask = conf_scores[cl].gt(self.conf_thresh)
-            if c_mask.sum() == 0:
-                output = torch.Tensor([0.0, -1.0, -1.0, -1.0, -1.0, -1.0, -1.0]).view(1,1,1,7)
-                return Variable(conf.data.new().resize_(output.size()).copy_(output))
-            scores = conf_scores[cl][c_mask]
-            l_mask = c_mask.unsqueeze(1).expand_as(decoded_boxes)
-            boxes = decoded_boxes[l_mask].view(-1, 4)
-            # idx of highest scoring and non-overlapping boxes per class
-            ids, count = nms(boxes, scores, self.nms_thresh, self.top_k)
-            count = min(count, self.keep_top_k)
-            extra_info = torch.FloatTensor([0.0, 1.0]).view(1,2).expand(num_priors,2)
-            extra_info = conf.data.new().resize_(extra_info.size()).copy_(extra_info)
-            output = torch.cat((extra_info[ids[:count]], scores[ids[:count]].unsqueeze(1),
-                           boxes[ids[:count]]), 1)
-                
-            #flt = self.output[:, :, :count, :].contiguous().view(-1, 5)
-            return Variable(output.unsqueeze(0).unsqueeze(0))
+        num_priors = prior.size(2) // 4
+        loc_data = loc.data.view(num, num_priors, 4)
+        conf_data = conf.data.view(num, num_priors, self.num_classes)
+        prior_data = center_size(prior.data[0][0].view(-1, 4))
+
+        outputs = []
+        for i in range(num):
+            # candidates above conf_thresh, class by class, the background
+            # class never makes it
+            conf_scores = conf_data[i].t()
+            c_mask = conf_scores.gt(self.conf_thresh)
+            if 0 <= self.background_label < self.num_classes:
+                c_mask[self.background_label] = 0
+            labels, prior_ids = c_mask.nonzero(as_tuple=True)
+            if 0 < self.top_k < labels.numel() and \
+               torch.bincount(labels, minlength=self.num_classes).max() > self.top_k:
+                # crowded classes, take the top_k of every class first
+                _, top_ids = conf_scores.topk(self.top_k, 1)
+                labels, ranks = c_mask.gather(1, top_ids).nonzero(as_tuple=True)
+                prior_ids = top_ids[labels, ranks]
+            scores = conf_data[i][prior_ids, labels]
+            # decode the candidates only, then one nms over all classes
+            boxes = decode(loc_data[i][prior_ids], prior_data[prior_ids], self.variance)
+            ids, count = batched_nms(boxes, scores, labels, self.nms_thresh, -1)
+            if count == 0:
+                continue
+            # keep_top_k is applied across classes, the result grouped by class
+            ids = ids[:count]
+            if self.keep_top_k >= 0:
+                ids = ids[:self.keep_top_k]
+            ids = ids[labels[ids].sort(stable=True)[1]]
+            image_ids = scores.new_full((ids.size(0), 1), i)
+            outputs.append(torch.cat((image_ids, labels[ids].unsqueeze(1).to(scores.dtype),
+                                      scores[ids].unsqueeze(1), boxes[ids]), 1))
+
+        if len(outputs) == 0:
+            # like caffe, only a batch without any detection gets filler
+            # rows, one row of -1 with its image_id per image
+            outputs = conf_data.new_full((num, 7), -1)
+            outputs[:, 0] = torch.arange(num, dtype=outputs.dtype)
         else:
-            loc_data = loc_data[0].view(-1, 4).clone()
-            prior_data = center_size(prior_data[0][0].view(-1,4).clone())
-            decoded_boxes = decode(loc_data, prior_data, self.variance)
-            #decoded_boxes = clip_boxes(decoded_boxes)
-            
-            # For each class, perform nms
-            conf_scores = conf_preds[0].clone()
-            num_det = 0
-            cl = 1
-            outputs = []
-            for cl in range(1, num_classes):
-                c_mask = conf_scores[cl].gt(self.conf_thresh)
-                if c_mask.sum() == 0:
-                    continue
-                scores = conf_scores[cl][c_mask]
-                l_mask = c_mask.unsqueeze(1).expand_as(decoded_boxes)
-                boxes = decoded_boxes[l_mask].view(-1, 4)
-                # idx of highest scoring and non-overlapping boxes per class
-                ids, count = nms(boxes, scores, self.nms_thresh, self.top_k)
-                count = min(count, self.keep_top_k)
-                extra_info = torch.FloatTensor([0.0, cl]).view(1,2).expand(count,2)
-                extra_info = conf.data.new().resize_(extra_info.size()).copy_(extra_info)
-                output = torch.cat((extra_info, scores[ids[:count]].unsqueeze(1),
-                               boxes[ids[:count]]), 1)
-                outputs.append(output)
-                    
             outputs = torch.cat(outputs, 0)
-                #flt = self.output[:, :, :count, :].contiguous().view(-1, 5)
-            return Variable(outputs.unsqueeze(0).unsqueeze(0))
+        return Variable(outputs.unsqueeze(0).unsqueeze(0))
 
 class MultiBoxLoss(nn.Module):
     """SSD Weighted Loss Function
@@ -375,7 +441,8 @@ class MultiBoxLoss(nn.Module):
     """
 
     def __init__(self, num_classes, overlap_thresh, prior_for_matching,
-                 bkg_label, neg_mining, neg_pos, neg_overlap, use_gpu=True):
+                 bkg_label, neg_mining, neg_pos, neg_overlap, use_gpu=True,
+                 max_overlaps=1 << 21):
         super(MultiBoxLoss, self).__init__()
         self.use_gpu = use_gpu
         self.num_classes = num_classes
@@ -386,6 +453,22 @@ class MultiBoxLoss(nn.Module):
         self.negpos_ratio = neg_pos
         self.neg_overlap = neg_overlap
         self.variance = [0.1, 0.2]
+        self.max_overlaps = max_overlaps
+        self.priors = None
+
+    def prior_forms(self, priors):
+        """Center-size and point form of the point form priors of a PriorBox
+        layer, cached as long as the same prior set comes in.
+        """
+        if self.priors is not None:
+            raw, center, point = self.priors
+            if raw.size() == priors.size() and raw.device == priors.device and \
+               raw.dtype == priors.dtype and torch.equal(raw, priors):
+                return center, point
+        center = center_size(priors)
+        point = point_form(center)
+        self.priors = (priors.clone(), center, point)
+        return center, point
 
     def forward(self, loc_data, conf_data, priors, targets):
         """Multibox Loss
@@ -400,68 +483,68 @@ class MultiBoxLoss(nn.Module):
         """
         #loc_data, conf_data, priors = predictions
         num = loc_data.size(0)
-        num_priors = (loc_data.size(1)/4)
+        num_priors = loc_data.size(1) // 4
         num_classes = self.num_classes
         loc_data = loc_data.view(num, num_priors, 4)
         conf_data = conf_data.view(num, num_priors, num_classes)
-        priors = priors[0][0].view(num_priors, 4)
-        targets = targets.view(-1, 8)
+        defaults, defaults_point = self.prior_forms(priors[0][0].data.view(num_priors, 4))
+        targets = targets.data.view(-1, 8).to(loc_data.device)
+
+        # pad the ground truths of the batch to [num, max_objects, 4]
+        image_ids = targets[:, 0].long()
+        keep = (image_ids >= 0) & (image_ids < num)
+        targets, image_ids = targets[keep], image_ids[keep]
+        image_ids, order = image_ids.sort(stable=True)
+        targets = targets[order]
+        counts = torch.bincount(image_ids, minlength=num)
+        starts = counts.cumsum(0) - counts
+        slots = torch.arange(image_ids.numel(), device=loc_data.device) - starts[image_ids]
+        num_objs = max(int(counts.max()), 1)
+        truths = targets.new_zeros(num, num_objs, 4)
+        labels = targets.new_zeros(num, num_objs)
+        valid = torch.zeros(num, num_objs, dtype=torch.bool, device=loc_data.device)
+        truths[image_ids, slots] = targets[:, 3:7]
+        labels[image_ids, slots] = targets[:, 1]
+        valid[image_ids, slots] = True
 
         # match priors (default boxes) and ground truth boxes
-        loc_t = torch.Tensor(num, num_priors, 4)
-        conf_t = torch.zeros(num, num_priors).long()
-        for idx in range(num):
-            sub_mask = (targets[:,0] == idx)
-            if sub_mask.data.float().sum() == 0:
-                continue
-            sub_targets = targets[sub_mask.view(-1,1).expand_as(targets)].view(-1,8)
-            truths = sub_targets[:, 3:7].data
-            labels = sub_targets[:, 1].data
-            defaults = priors.data
-            defaults = center_size(defaults)
-            match(self.threshold, truths, defaults, self.variance, labels,
-                  loc_t, conf_t, idx)
-        if self.use_gpu:
-            loc_t = loc_t.cuda()
-            conf_t = conf_t.cuda()
+        loc_t, conf_t = match_batch(self.threshold, truths, valid, defaults,
+                                    defaults_point, self.variance, labels,
+                                    self.max_overlaps)
         # wrap targets
         loc_t = Variable(loc_t, requires_grad=False)
         conf_t = Variable(conf_t, requires_grad=False)
 
         pos = conf_t > 0
-        num_pos = pos.sum(keepdim=True)
+        num_pos = pos.long().sum(1)
 
         # Localization Loss (Smooth L1)
         # Shape: [batch,num_priors,4]
-        pos_idx = pos.unsqueeze(pos.dim()).expand_as(loc_data)
-        loc_p = loc_data[pos_idx].view(-1, 4)
-        loc_t = loc_t[pos_idx].view(-1, 4)
-        loss_l = F.smooth_l1_loss(loc_p, loc_t, size_average=False)
-
-        # Compute max conf across batch for hard negative mining
-        batch_conf = conf_data.view(-1, self.num_classes)
-
-        loss_c = log_sum_exp(batch_conf).view(-1,1) - batch_conf.gather(1, conf_t.view(-1, 1))
-
-        # Hard Negative Mining
-        loss_c[pos] = 0  # filter out pos boxes for now
-        loss_c = loss_c.view(num, -1)
-        _, loss_idx = loss_c.sort(1, descending=True)
-        _, idx_rank = loss_idx.sort(1)
-        num_pos = pos.long().sum(1, keepdim=True)
-        num_neg = Variable(torch.clamp(self.negpos_ratio*num_pos.data.float(), max=pos.size(1)-1).long())
-        neg = idx_rank < num_neg.expand_as(idx_rank)
+        loss_l = F.smooth_l1_loss(loc_data[pos], loc_t[pos], reduction='sum')
+
+        # Hard Negative Mining: only the negpos_ratio*num_pos hardest
+        # negatives of each image are needed, so take a top-k of the
+        # background loss instead of ranking all priors
+        # floored like caffe, a fractional negpos_ratio must not round up
+        num_neg = torch.clamp(self.negpos_ratio*num_pos, max=num_priors-1).long()
+        max_neg = int(num_neg.max())
+        with torch.no_grad():
+            loss_b = torch.logsumexp(conf_data.data, 2) - conf_data.data[:, :, 0]
+            loss_b[pos] = -float('inf')  # filter out pos boxes
+            _, neg_idx = loss_b.topk(max_neg, 1)
+            neg = torch.arange(max_neg, device=num_neg.device) < num_neg[:, None]
+            neg &= ~pos.gather(1, neg_idx)
 
         # Confidence Loss Including Positive and Negative Examples
-        pos_idx = pos.unsqueeze(2).expand_as(conf_data)
-        neg_idx = neg.unsqueeze(2).expand_as(conf_data)
-        conf_p = conf_data[(pos_idx+neg_idx).gt(0)].view(-1, self.num_classes)
-        targets_weighted = conf_t[(pos+neg).gt(0)]
-        loss_c = F.cross_entropy(conf_p, targets_weighted, size_average=False)
+        loss_c = F.cross_entropy(conf_data[pos], conf_t[pos], reduction='sum')
+        if max_neg > 0:
+            conf_n = conf_data.gather(1, neg_idx[:, :, None].expand(-1, -1, num_classes))
+            conf_n = conf_n[neg]
+            loss_c = loss_c + (torch.logsumexp(conf_n, 1) - conf_n[:, 0]).sum()
 
         # Sum of losses: L(x,c,l,g) = (Lconf(x, c) + ¦Áloc(x,l,g)) / N
 
-        N = num_pos.data.sum()
+        N = num_pos.sum()
         loss_l /= N
         loss_c /= N
         return loss_l + loss_c
@@ -0,0 +1,185 @@
+# -*- coding:utf-8 -*-
+import torch
+import torch.nn.functional as F
+from torch.autograd import Variable
+from collections import OrderedDict
+from detection import batched_nms
+
+def detection_layer(net):
+    """Find the DetectionOutput layer of a CaffeNet.
+    Return:
+        (name, module, bottom names, top name) of the layer.
+    """
+    for layer in net.layer_specs:
+        if layer.type == 'DetectionOutput':
+            return layer.name, net.models[layer.name], list(layer.bottom), layer.top[0]
+    raise ValueError('network has no DetectionOutput layer')
+
+
+def tile_origins(size, tile, overlap):
+    """Start offsets of tiles of length tile covering size, neighbouring
+    tiles share at least overlap pixels. The last tile is aligned to the
+    end, a size below tile gets a single tile.
+    """
+    if size <= tile:
+        return [0]
+    stride = tile - overlap
+    if stride <= 0:
+        raise ValueError('overlap %d must be smaller than the tile size %d' % (overlap, tile))
+    return list(range(0, size - tile, stride)) + [size - tile]
+
+
+def merge_detections(labels, scores, boxes, nms_thresh, keep_top_k=-1):
+    """Suppress duplicates of the same object with one nms over all classes
+    and lay the kept detections out like the DetectionOutput layer.
+    Args:
+        labels: (tensor) Class of every detection, Shape: [num_det].
+        scores: (tensor) Score of every detection, Shape: [num_det].
+        boxes: (tensor) Normalized boxes, Shape: [num_det,4].
+        nms_thresh: (float) The overlap thresh for suppressing unnecessary boxes.
+        keep_top_k: (int) Maximum number of detections to keep, -1 keeps all.
+    Return:
+        (tensor) Shape: [1,1,num_det,7], rows of
+        [0, label, score, xmin, ymin, xmax, ymax], a row of -1 without detections.
+    """
+    ids, count = batched_nms(boxes, scores, labels, nms_thresh, -1)
+    if count == 0:
+        return Variable(scores.new_tensor([0, -1, -1, -1, -1, -1, -1]).view(1, 1, 1, 7))
+    ids = ids[:count]
+    if keep_top_k >= 0:
+        ids = ids[:keep_top_k]
+    ids = ids[labels[ids].sort(stable=True)[1]]
+    outputs = torch.cat((scores.new_zeros(ids.size(0), 1), labels[ids].unsqueeze(1).to(scores.dtype),
+                         scores[ids].unsqueeze(1), boxes[ids]), 1)
+    return Variable(outputs.unsqueeze(0).unsqueeze(0))
+
+
+def detect_tiled(net, image, overlap=64, batch_size=8, nms_thresh=None, keep_top_k=-1):
+    """Run a detection net on an image larger than its input size.
+    The image is cut into overlapping tiles of net.width x net.height, the
+    tiles go through the net batch_size at a time and their detections
+    are mapped back to the image and merged with nms, so memory is bounded
+    by the batch whatever the image size. Objects cut by a tile border are
+    seen whole by the neighbouring tile as long as they are smaller than
+    overlap.
+    Args:
+        net: (CaffeNet) A net with a DetectionOutput layer.
+        image: (tensor) Preprocessed image, Shape: [1,C,H,W] or [C,H,W],
+            a single image, run batches image by image.
+        overlap: (int) Pixels shared by neighbouring tiles.
+        batch_size: (int) Number of tiles per forward.
+        nms_thresh: (float) Overlap thresh of the merge, defaults to the one
+            of the DetectionOutput layer.
+        keep_top_k: (int) Maximum number of detections of the image, -1 keeps all.
+    Return:
+        (tensor) Shape: [1,1,num_det,7] like the DetectionOutput layer, the
+        boxes normalized to the whole image.
+    """
+    _, detector, _, top = detection_layer(net)
+    if nms_thresh is None:
+        nms_thresh = detector.nms_thresh
+    image = image.data.view(-1, *image.size()[-3:])
+    if image.size(0) != 1:
+        raise ValueError('detect_tiled takes a single image, got a batch of %d' % image.size(0))
+    height, width = image.size(2), image.size(3)
+    tile_w, tile_h = net.width, net.height
+    if height < tile_h or width < tile_w:
+        image = F.pad(image, (0, max(tile_w - width, 0), 0, max(tile_h - height, 0)))
+    origins = [(x, y) for y in tile_origins(height, tile_h, overlap)
+                      for x in tile_origins(width, tile_w, overlap)]
+
+    labels, scores, boxes = [], [], []
+    tile_size = image.new_tensor([tile_w, tile_h, tile_w, tile_h])
+    with torch.no_grad():
+        for start in range(0, len(origins), batch_size):
+            chunk = origins[start:start+batch_size]
+            batch = torch.cat([image[:, :, y:y+tile_h, x:x+tile_w] for x, y in chunk], 0)
+            dets = net(batch, outputs=[top])[top].data.view(-1, 7)
+            dets = dets[dets[:, 1] >= 0]
+            # tile coordinates to image pixels
+            offsets = image.new_tensor(chunk)[dets[:, 0].long()].repeat(1, 2)
+            labels.append(dets[:, 1].long())
+            scores.append(dets[:, 2])
+            boxes.append(dets[:, 3:7] * tile_size + offsets)
+    boxes = torch.cat(boxes, 0) / image.new_tensor([width, height, width, height])
+    return merge_detections(torch.cat(labels, 0), torch.cat(scores, 0), boxes,
+                            nms_thresh, keep_top_k)
+
+
+class PyramidDetector(object):
+    """Multi-scale inference of a detection net. The image is resized to
+    every scale, scales whose sizes pad to the same shape are run as one
+    batch, and the loc/conf/prior bottoms of the DetectionOutput layer of
+    all scales are concatenated so that a single DetectionOutput pass
+    decodes them and suppresses duplicates across scales.
+    Priors are normalized to the padded input; they are rescaled to the
+    image so that the boxes of every scale come out in image coordinates.
+    The scale groups and the merged priors are cached per input size, for
+    the cache_size most recently used sizes.
+    """
+    def __init__(self, net, scales, align=32):
+        self.net = net
+        self.scales = scales
+        self.align = align
+        _, self.detector, self.bottoms, _ = detection_layer(net)
+        self.configs = OrderedDict()
+        self.cache_size = 8
+
+    def __repr__(self):
+        return 'PyramidDetector(scales=%s, align=%d)' % (self.scales, self.align)
+
+    def config(self, height, width, device, dtype):
+        """Scale groups {padded shape: [scaled sizes]} for an input size and
+        the merged priors once known.
+        """
+        key = (height, width, device, dtype)
+        config = self.configs.get(key)
+        if config is None:
+            groups = OrderedDict()
+            for scale in self.scales:
+                h = max(int(round(height * scale)), 1)
+                w = max(int(round(width * scale)), 1)
+                shape = (-(-h // self.align) * self.align, -(-w // self.align) * self.align)
+                groups.setdefault(shape, []).append((h, w))
+            config = [groups, None]
+            self.configs[key] = config
+            while len(self.configs) > self.cache_size:
+                self.configs.popitem(last=False)
+        else:
+            self.configs.move_to_end(key)
+        return config
+
+    def __call__(self, image):
+        """
+        Args:
+            image: (tensor) Preprocessed images, Shape: [batch,C,H,W] or [C,H,W].
+        Return:
+            (tensor) Shape: [1,1,num_det,7] like the DetectionOutput layer.
+        """
+        image = image.data.view(-1, *image.size()[-3:])
+        num, _, height, width = image.size()
+        config = self.config(height, width, image.device, image.dtype)
+        groups, priors = config
+
+        locs, confs, scale_priors = [], [], []
+        with torch.no_grad():
+            for (ph, pw), sizes in groups.items():
+                inputs = []
+                for h, w in sizes:
+                    scaled = image
+                    if (h, w) != (height, width):
+                        scaled = F.interpolate(image, size=(h, w), mode='bilinear', align_corners=False)
+                    inputs.append(F.pad(scaled, (0, pw - w, 0, ph - h)))
+                blobs = self.net(torch.cat(inputs, 0), outputs=self.bottoms)
+                loc, conf, prior = [blobs[name].data for name in self.bottoms]
+                locs += loc.view(len(sizes), num, -1).unbind(0)
+                confs += conf.view(len(sizes), num, -1).unbind(0)
+                if priors is None:
+                    boxes = prior[0, 0].view(-1, 4)
+                    for h, w in sizes:
+                        ratio = boxes.new_tensor([float(pw) / w, float(ph) / h]).repeat(2)
+                        scale_priors.append(torch.stack([(boxes * ratio).view(-1), prior[0, 1]]))
+            if priors is None:
+                priors = torch.cat(scale_priors, 1).unsqueeze(0)
+                config[1] = priors
+            return self.detector(torch.cat(locs, 1), torch.cat(confs, 1), priors)
@@ -0,0 +1,310 @@
+# Static shape, FLOP and memory analysis of a caffe network, without
+# building it. FLOPs count a multiply-add as 2, other elementwise ops as
+# 1 per output element; memory covers blobs and parameters, not the
+# temporaries inside layer kernels.
+from __future__ import print_function
+from __future__ import division
+import argparse
+from collections import OrderedDict
+from prototxt import parse_prototxt, decode_layers, input_dims
+
+# layer types build_plan does not execute
+SKIPPED_TYPES = ['Data', 'Accuracy', 'SoftmaxWithLoss', 'Region']
+# layer types whose outputs are views of their input
+VIEW_TYPES = ['Dropout', 'Flatten', 'Reshape', 'Slice']
+# layer types whose modules create new tensors, the others work in place
+# or return views of their input
+FRESH_TYPES = ['Convolution', 'Pooling', 'InnerProduct', 'BatchNorm', 'Scale', 'Eltwise',
+               'Concat', 'Normalize', 'LRN', 'Softmax']
+
+def prod(values):
+    result = 1
+    for v in values:
+        result *= v
+    return result
+
+def pool_size(size, kernel_size, stride, pad):
+    # ceil mode like caffe, the last window must start inside the input
+    out = -(-(size + 2*pad - kernel_size) // stride) + 1
+    if (out - 1) * stride >= size + pad:
+        out -= 1
+    return out
+
+def num_priors(layer):
+    aspect_ratios = [1.0]
+    for ar in layer.aspect_ratio:
+        if any(abs(ar - a) < 1e-6 for a in aspect_ratios):
+            continue
+        aspect_ratios.append(ar)
+        if layer.flip:
+            aspect_ratios.append(1.0/ar)
+    return len(layer.min_size) * len(aspect_ratios) + len(layer.max_size)
+
+def layer_cost(layer, shapes):
+    """Top shapes, FLOPs and parameter count of a layer.
+    Args:
+        layer: (LayerSpec) The layer.
+        shapes: (list) Shapes of its bottom blobs, batch first.
+    Return:
+        ([top shapes], flops, params)
+    """
+    ltype = layer.type
+    shape = shapes[0]
+    numel = prod(shape)
+    if ltype == 'Convolution':
+        k, s, p = layer.kernel_size, layer.stride, layer.pad
+        top = (shape[0], layer.num_output, (shape[2] + 2*p - k)//s + 1, (shape[3] + 2*p - k)//s + 1)
+        weights = layer.num_output * shape[1] // layer.group * k * k
+        flops = 2 * weights // layer.num_output * prod(top)
+        if layer.bias_term:
+            return [top], flops + prod(top), weights + layer.num_output
+        return [top], flops, weights
+    elif ltype == 'BatchNorm':
+        return [shape], 2 * numel, 2 * shape[1]
+    elif ltype == 'Scale':
+        if len(shapes) == 2:
+            weights = 0
+            bias = prod(shapes[1]) if layer.bias_term else 0
+        else:
+            axis = layer.axis % len(shape)
+            weights = prod(shape[axis:] if layer.num_axes == -1 else shape[axis:axis+layer.num_axes])
+            bias = weights if layer.bias_term else 0
+        return [shape], numel * (2 if bias else 1), weights + bias
+    elif ltype == 'ReLU':
+        return [shape], numel, 0
+    elif ltype == 'Pooling':
+        k, s, p = layer.kernel_size, layer.stride, layer.pad
+        top = (shape[0], shape[1], pool_size(shape[2], k, s, p), pool_size(shape[3], k, s, p))
+        return [top], prod(top) * k * k, 0
+    elif ltype == 'Eltwise':
+        ops = len(shapes) - 1 if layer.coeff is None else 2 * len(shapes) - 1
+        return [shape], numel * ops, 0
+    elif ltype == 'InnerProduct':
+        channels = prod(shape[1:])
+        top = (shape[0], layer.num_output)
+        # the Linear module always has a bias
+        return [top], 2 * channels * prod(top) + prod(top), channels * layer.num_output + layer.num_output
+    elif ltype == 'Normalize':
+        return [shape], 4 * numel, shape[1]
+    elif ltype == 'LRN':
+        window = layer.local_size if layer.norm_region == 'ACROSS_CHANNELS' else layer.local_size ** 2
+        return [shape], numel * (window + 4), 0
+    elif ltype == 'Permute':
+        return [tuple(shape[i] for i in layer.order)], 0, 0
+    elif ltype == 'Flatten':
+        axis = layer.axis % len(shape)
+        return [(prod(shape[:axis]), prod(shape[axis:]))], 0, 0
+    elif ltype == 'Slice':
+        axis = layer.axis % len(shape)
+        num = len(layer.top)
+        if len(layer.slice_point) == 0:
+            points = [shape[axis] * (i+1) // num for i in range(num)]
+        else:
+            points = list(layer.slice_point) + [shape[axis]]
+        tops = []
+        prev = 0
+        for point in points:
+            top = list(shape)
+            top[axis] = point - prev
+            tops.append(tuple(top))
+            prev = point
+        return tops, 0, 0
+    elif ltype == 'Concat':
+        axis = layer.axis % len(shape)
+        top = list(shape)
+        top[axis] = sum(s[axis] for s in shapes)
+        return [tuple(top)], 0, 0
+    elif ltype == 'PriorBox':
+        return [(1, 2, shape[2] * shape[3] * num_priors(layer) * 4)], 0, 0
+    elif ltype == 'Reshape':
+        dims = [shape[i] if dim == 0 else dim for i, dim in enumerate(layer.dims)]
+        if -1 in dims:
+            dims[dims.index(-1)] = numel // -prod(dims)
+        return [tuple(dims)], 0, 0
+    elif ltype == 'Softmax':
+        return [shape], 3 * numel, 0
+    elif ltype == 'DetectionOutput':
+        # data dependent, the upper bound of the number of detections
+        priors = shapes[2][2] // 4
+        rows = priors * (layer.num_classes - 1)
+        if layer.top_k > 0:
+            rows = min(rows, layer.top_k * (layer.num_classes - 1))
+        if layer.keep_top_k > 0:
+            rows = min(rows, layer.keep_top_k)
+        return [(1, 1, shape[0] * rows, 7)], 0, 0
+    elif ltype == 'Dropout':
+        return [shape], 0, 0
+    print('analyze: unknown type %s, assuming the shape of its input' % ltype)
+    return [shape] * len(layer.top), 0, 0
+
+def inplace_eltwise(layers, output_names):
+    """Indices of the Eltwise layers that can accumulate into their first
+    input in memory-lean mode, because nothing reads its storage later.
+
+    Every blob lives in a storage: layers of FRESH_TYPES create one, the
+    others (in-place ReLU, Dropout, views like Slice/Reshape/Flatten)
+    share their input's. The net input and the cached PriorBox outputs
+    must never be written to.
+    Args:
+        layers: (list) Layer specs of the executed steps, in order.
+        output_names: (list) Blobs kept after the forward.
+    """
+    storage = {'data': None}
+    step_storage = []
+    last_read = dict()
+    for index, layer in enumerate(layers):
+        for name in layer.bottom:
+            last_read[storage.get(name)] = index
+        step_storage.append([storage.get(name) for name in layer.bottom])
+        if layer.type == 'PriorBox':
+            token = None
+        elif layer.type in FRESH_TYPES:
+            token = index
+        else:
+            token = storage.get(layer.bottom[0])
+        for name in layer.top:
+            storage[name] = token
+    for name in output_names:
+        last_read[storage.get(name)] = len(layers)
+    inplace = set()
+    for index, layer in enumerate(layers):
+        if layer.type != 'Eltwise':
+            continue
+        first = step_storage[index][0]
+        if first is not None and last_read[first] == index and step_storage[index].count(first) == 1:
+            inplace.add(index)
+    return inplace
+
+class LayerCost(object):
+    """Cost of one executed layer. live_bytes is the memory of all blobs
+    alive while the layer runs, its own outputs included."""
+    __slots__ = ('name', 'type', 'top_shapes', 'flops', 'param_bytes', 'activation_bytes', 'live_bytes')
+
+    def __init__(self, name, ltype, top_shapes, flops, param_bytes):
+        self.name = name
+        self.type = ltype
+        self.top_shapes = top_shapes
+        self.flops = flops
+        self.param_bytes = param_bytes
+        self.activation_bytes = 0
+        self.live_bytes = 0
+
+    def __repr__(self):
+        return 'LayerCost(%s)' % ', '.join('%s=%r' % (attr, getattr(self, attr)) for attr in self.__slots__)
+
+class NetAnalysis(object):
+    """Result of analyze_net.
+    blob_shapes: {blob: shape}, batch first.
+    layers: [LayerCost] in execution order.
+    flops, param_bytes: totals of the layers.
+    peak_bytes, peak_layer: highest live blob memory and the layer it
+        is reached at; parameters come on top.
+    """
+    def __init__(self, blob_shapes, layers, lean, bytes_per_element):
+        self.blob_shapes = blob_shapes
+        self.layers = layers
+        self.lean = lean
+        self.bytes_per_element = bytes_per_element
+        self.flops = sum(layer.flops for layer in layers)
+        self.param_bytes = sum(layer.param_bytes for layer in layers)
+        peak = max(layers, key=lambda layer: layer.live_bytes) if layers else None
+        self.peak_bytes = peak.live_bytes if peak else 0
+        self.peak_layer = peak.name if peak else None
+
+    def report(self):
+        lines = ['%-30s %-16s %-24s %12s %10s %10s %10s' %
+                 ('layer', 'type', 'output', 'MFLOPs', 'params KB', 'output KB', 'live MB')]
+        for layer in self.layers:
+            shape = 'x'.join(str(d) for d in layer.top_shapes[0])
+            if len(layer.top_shapes) > 1:
+                shape += ' (+%d)' % (len(layer.top_shapes) - 1)
+            lines.append('%-30s %-16s %-24s %12.2f %10.1f %10.1f %10.2f%s' %
+                         (layer.name, layer.type, shape, layer.flops / 1e6, layer.param_bytes / 1024.0,
+                          layer.activation_bytes / 1024.0, layer.live_bytes / 1048576.0,
+                          ' <- peak' if layer.name == self.peak_layer else ''))
+        lines.append('total %.3f GFLOPs, params %.2f MB, peak blobs %.2f MB at %s (%s), peak total %.2f MB' %
+                     (self.flops / 1e9, self.param_bytes / 1048576.0, self.peak_bytes / 1048576.0, self.peak_layer,
+                      'memory-lean' if self.lean else 'all blobs kept', (self.peak_bytes + self.param_bytes) / 1048576.0))
+        return '\n'.join(lines)
+
+def analyze_net(net_info, batch_size=1, width=None, height=None, bytes_per_element=4, lean=False):
+    """Infer the shape of every blob and the cost of every layer in the
+    order CaffeNet executes them.
+    Args:
+        net_info: (dict) Parsed prototxt, see parse_prototxt.
+        batch_size: (int) Batch of the input.
+        width, height: (int) Input size, defaults to the one of the prototxt.
+        bytes_per_element: (int) 4 for float32, 2 for float16.
+        lean: (bool) Model memory-lean mode, where blobs are released after
+            their last use, instead of keeping every blob.
+    Return:
+        (NetAnalysis)
+    """
+    _, channels, input_height, input_width = input_dims(net_info['props'])
+    if width is not None and height is not None:
+        input_width, input_height = width, height
+    blob_shapes = OrderedDict()
+    blob_shapes['data'] = (batch_size, channels, input_height, input_width)
+
+    layers = [layer for layer in decode_layers(net_info) if layer.type not in SKIPPED_TYPES]
+    costs = []
+    for layer in layers:
+        top_shapes, flops, params = layer_cost(layer, [blob_shapes[name] for name in layer.bottom])
+        for name, shape in zip(layer.top, top_shapes):
+            blob_shapes[name] = shape
+        costs.append(LayerCost(layer.name, layer.type, top_shapes, flops, params * bytes_per_element))
+    # outputs are the blobs nobody reads, like in build_plan
+    consumed = set(name for layer in layers for name in layer.bottom)
+    outputs = [name for name in blob_shapes if name not in consumed]
+
+    inplace = inplace_eltwise(layers, outputs) if lean else set()
+    last_use = dict()
+    for index, layer in enumerate(layers):
+        for name in layer.bottom + layer.top:
+            last_use[name] = index
+    for name in outputs:
+        last_use.pop(name, None)
+
+    # Every blob slot refers to a storage, views and in-place layers share
+    # the storage of their input. A storage lives while a slot refers to
+    # it; the input is also held by the caller and the priors by the
+    # PriorBox cache.
+    slots = {'data': 'data'}
+    storage_bytes = {'data': prod(blob_shapes['data']) * bytes_per_element}
+    refs = {'data': 2}
+    live = storage_bytes['data']
+    for index, (layer, cost) in enumerate(zip(layers, costs)):
+        if layer.type in VIEW_TYPES or index in inplace or (layer.type == 'ReLU' and layer.top == layer.bottom):
+            token = slots[layer.bottom[0]]
+        else:
+            token = index
+            cost.activation_bytes = sum(prod(shape) for shape in cost.top_shapes) * bytes_per_element
+            storage_bytes[index] = cost.activation_bytes
+            refs[index] = 1 if layer.type == 'PriorBox' else 0
+            live += storage_bytes[index]
+        cost.live_bytes = live
+        released = [slots.get(name) for name in layer.top]
+        for name in layer.top:
+            slots[name] = token
+            refs[token] += 1
+        if lean:
+            released += [slots.pop(name) for name in set(layer.bottom + layer.top) if last_use.get(name) == index]
+        for old in released:
+            if old is not None:
+                refs[old] -= 1
+                if refs[old] == 0:
+                    live -= storage_bytes[old]
+    return NetAnalysis(blob_shapes, costs, lean, bytes_per_element)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='shape, FLOP and memory report of a caffe network')
+    parser.add_argument('protofile', type=str)
+    parser.add_argument('--batch', default=1, type=int)
+    parser.add_argument('--width', default=None, type=int)
+    parser.add_argument('--height', default=None, type=int)
+    parser.add_argument('--bytes', default=4, type=int, help='bytes per element, 2 for float16')
+    parser.add_argument('--lean', action='store_true', help='memory-lean mode, blobs are released after their last use')
+    args = parser.parse_args()
+
+    analysis = analyze_net(parse_prototxt(args.protofile), args.batch, args.width, args.height, args.bytes, args.lean)
+    print(analysis.report())
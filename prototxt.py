@@ -1,7 +1,11 @@
 # 2017.12.16 by xiaohang
 from __future__ import print_function
 from __future__ import division
+import os
+import re
+import json
 from collections import OrderedDict
+import numpy as np
 import caffe.proto.caffe_pb2 as caffe_pb2
 
 def parse_caffemodel(caffemodel):
@@ -13,70 +17,224 @@ def parse_caffemodel(caffemodel):
     return model
 
 
-def parse_prototxt(protofile):
-    def line_type(line):
-        if line.find(':') >= 0:
-            return 0
-        elif line.find('{') >= 0:
-            return 1
-        return -1
-
-    def parse_block(fp):
-        block = OrderedDict()
-        line = fp.readline().strip()
-        while line != '}':
-            ltype = line_type(line)
-            if ltype == 0: # key: value
-                #print line
-                line = line.split('#')[0]
-                key, value = line.split(':')
-                key = key.strip()
-                value = value.strip().strip('"')
-                if key in block:
-                    if type(block[key]) == list:
-                        block[key].append(value)
-                    else:
-                        block[key] = [block[key], value]
-                else:
-                    block[key] = value
-            elif ltype == 1: # blockname {
-                key = line.split('{')[0].strip()
-                sub_block = parse_block(fp)
-                block[key] = sub_block
-            line = fp.readline().strip()
-            line = line.split('#')[0]
-        return block
-
-    fp = open(protofile, 'r')
-    props = OrderedDict()
+def read_varint(buf, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def iter_fields(buf, start, end):
+    """Walk the protobuf wire format of one message in buf[start:end].
+    Yields (field, wire_type, value), value is an int for varint/fixed
+    fields and a (start, end) span for length-delimited ones."""
+    pos = start
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        field = key >> 3
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == 5:
+            value = (pos, pos + 4)
+            pos += 4
+        elif wire_type == 1:
+            value = (pos, pos + 8)
+            pos += 8
+        else:
+            raise ValueError('unsupported protobuf wire type %d' % wire_type)
+        yield field, wire_type, value
+
+def parse_blob(buf, start, end):
+    # BlobProto: data = 5 (packed float), double_data = 8 (packed double)
+    chunks = []
+    for field, wire_type, value in iter_fields(buf, start, end):
+        if field != 5 and field != 8:
+            continue
+        pos, stop = value
+        dtype = '<f4' if field == 5 else '<f8'
+        data = np.frombuffer(buf, dtype=dtype, count=(stop-pos)//np.dtype(dtype).itemsize, offset=pos)
+        chunks.append(data.astype(np.float32, copy=False))
+    if len(chunks) == 1:
+        return chunks[0]
+    elif len(chunks) == 0:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks)
+
+def parse_caffemodel_blobs(caffemodel):
+    """Read the blobs of every layer of a caffemodel without building
+    protobuf objects. The float data is mapped with np.frombuffer straight
+    from the file contents, so no per-element Python objects are created.
+    Returns an OrderedDict layer name -> list of flat float32 arrays."""
+    print('Loading caffemodel: ', caffemodel)
+    buf = bytearray(os.path.getsize(caffemodel))
+    with open(caffemodel, 'rb') as fp:
+        fp.readinto(buf)
+
+    blobs = OrderedDict()
+    for field, wire_type, value in iter_fields(buf, 0, len(buf)):
+        # NetParameter: layer = 100 (LayerParameter), layers = 2 (V1LayerParameter)
+        if field == 100:
+            name_field, blobs_field = 1, 7
+        elif field == 2 and wire_type == 2:
+            name_field, blobs_field = 4, 6
+        else:
+            continue
+        name = None
+        layer_blobs = []
+        for sub_field, sub_type, sub_value in iter_fields(buf, value[0], value[1]):
+            if sub_field == name_field and sub_type == 2:
+                name = bytes(buf[sub_value[0]:sub_value[1]]).decode('utf-8')
+            elif sub_field == blobs_field and sub_type == 2:
+                layer_blobs.append(parse_blob(buf, sub_value[0], sub_value[1]))
+        if name is not None and (name not in blobs or len(layer_blobs) > 0):
+            blobs[name] = layer_blobs
+    return blobs
+
+def load_blob_cache(data_file, index_file, key):
+    """The blobs cached in data_file, or None when the cache is missing,
+    stale or broken."""
+    if not os.path.exists(data_file) or not os.path.exists(index_file):
+        return None
+    try:
+        with open(index_file, 'r') as fp:
+            index = json.load(fp)
+        if index['key'] != key:
+            return None
+        data = np.load(data_file, mmap_mode='c')
+        if data.dtype != np.float32 or data.shape != (index['size'],):
+            raise ValueError('data does not match the index')
+        blobs = OrderedDict()
+        for name, spans in index['layers']:
+            for start, stop in spans:
+                if not 0 <= start <= stop <= data.size:
+                    raise ValueError('span %d:%d of %s out of range' % (start, stop, name))
+            blobs[name] = [data[start:stop] for start, stop in spans]
+    except Exception as e:
+        print('ignore broken caffemodel cache %s: %s' % (data_file, e))
+        return None
+    print('Loading cached caffemodel: ', data_file)
+    return blobs
+
+def load_caffemodel_blobs(caffemodel, use_cache=False):
+    """Like parse_caffemodel_blobs, optionally backed by an on-disk cache.
+
+    The cache lives next to the caffemodel: caffemodel.blobs.npy holds all
+    blobs as one flat float32 array and caffemodel.blobs.json the layout.
+    It is keyed by the size and mtime of the caffemodel and is loaded
+    memory-mapped, so warm starts skip protobuf parsing entirely. A cache
+    that cannot be read is ignored and rebuilt.
+    """
+    if not use_cache:
+        return parse_caffemodel_blobs(caffemodel)
+
+    stat = os.stat(caffemodel)
+    key = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    data_file = caffemodel + '.blobs.npy'
+    index_file = caffemodel + '.blobs.json'
+    blobs = load_blob_cache(data_file, index_file, key)
+    if blobs is not None:
+        return blobs
+
+    blobs = parse_caffemodel_blobs(caffemodel)
     layers = []
-    line = fp.readline()
-    while line != '':
-        line = line.strip().split('#')[0]
-        if line == '':
-            line = fp.readline()
+    offset = 0
+    for name, layer_blobs in blobs.items():
+        spans = []
+        for blob in layer_blobs:
+            spans.append([offset, offset + blob.size])
+            offset += blob.size
+        layers.append([name, spans])
+    size = max(offset, 1)
+    # workers may start together, write to temp files and rename, the
+    # index last so it never describes a data file that is not there
+    data_tmp = '%s.%d.tmp' % (data_file, os.getpid())
+    index_tmp = '%s.%d.tmp' % (index_file, os.getpid())
+    try:
+        data = np.lib.format.open_memmap(data_tmp, mode='w+', dtype=np.float32, shape=(size,))
+        for (name, spans), layer_blobs in zip(layers, blobs.values()):
+            for (start, stop), blob in zip(spans, layer_blobs):
+                data[start:stop] = blob
+        data.flush()
+        del data
+        with open(index_tmp, 'w') as fp:
+            json.dump({'key': key, 'size': size, 'layers': layers}, fp)
+        os.rename(data_tmp, data_file)
+        os.rename(index_tmp, index_file)
+    except (IOError, OSError) as e:
+        print('Unable to write caffemodel cache %s: %s' % (data_file, e))
+    return blobs
+
+# one match per statement: "key: value", "key {" (or "key: {"), "}" or a
+# comment, anything else is caught by the last group. Values are bare
+# words, quoted strings or [v1, v2] lists.
+STATEMENT_RE = re.compile(r'''\s*(?:(\w[\w.]*)\s*(?::\s*([^\s{}\[\]:,;#"']+|"[^"\\]*(?:\\.[^"\\]*)*"|'[^'\\]*(?:\\.[^'\\]*)*'|\[[^\]]*\])|:?\s*(\{))|(\})|#.*|([^\s,;]))''')
+LIST_ITEM_RE = re.compile(r'''"((?:[^"\\]|\\.)*)"|'((?:[^'\\]|\\.)*)'|([^\s,"']+)''')
+
+def parse_prototxt_text(text, source='<string>'):
+    """Parse protobuf text format in a single pass over its statements.
+    Values are kept as strings without their quotes, blocks as OrderedDicts,
+    and a key given several times holds the list of its values.
+    """
+    return parse_statements(STATEMENT_RE.findall(text), source)
+
+def parse_statements(statements, source):
+    root = OrderedDict()
+    block = root
+    stack = []
+    for key, value, open_block, close, unexpected in statements:
+        if value:
+            first = value[0]
+            if first == '"' or first == "'":
+                value = value[1:-1]
+            elif first == '[':
+                for item in LIST_ITEM_RE.findall(value[1:-1]):
+                    item = ''.join(item)
+                    if key not in block:
+                        block[key] = item
+                    elif type(block[key]) == list:
+                        block[key].append(item)
+                    else:
+                        block[key] = [block[key], item]
+                continue
+        elif open_block:
+            value = OrderedDict()
+        elif close:
+            if not stack:
+                raise ValueError('%s: unbalanced "}"' % source)
+            block = stack.pop()
             continue
-        ltype = line_type(line)
-        if ltype == 0: # key: value
-            key, value = line.split(':')
-            key = key.strip()
-            value = value.strip().strip('"')
-            # has_key was removed in Python 3
-            if key in props:
-               if type(props[key]) == list:
-                   props[key].append(value)
-               else:
-                   props[key] = [props[key], value]
-            else:
-                props[key] = value
-        elif ltype == 1: # blockname {
-            key = line.split('{')[0].strip()
-            if key == 'layer':
-                layer = parse_block(fp)
-                layers.append(layer)
-            else:
-                props[key] = parse_block(fp)
-        line = fp.readline()
+        elif unexpected:
+            raise ValueError('%s: unexpected "%s"' % (source, unexpected))
+        else:
+            continue  # comment
+        if key not in block:
+            block[key] = value
+        elif type(block[key]) == list:
+            block[key].append(value)
+        else:
+            block[key] = [block[key], value]
+        if open_block:
+            stack.append(block)
+            block = value
+    if stack:
+        raise ValueError('%s: unclosed block' % source)
+    return root
+
+def parse_prototxt(protofile):
+    with open(protofile, 'r') as fp:
+        props = parse_prototxt_text(fp.read(), protofile)
+    layers = props.pop('layer', [])
+    if type(layers) != list:
+        layers = [layers]
 
     if len(layers) > 0:
         net_info = OrderedDict()
@@ -86,6 +244,242 @@ def parse_prototxt(protofile):
     else:
         return props
 
+def input_dims(props):
+    """Dims of the first network input, from input_shape or input_dim."""
+    if 'input_shape' in props:
+        input_shape = props['input_shape']
+        if type(input_shape) == list:  # one per input
+            input_shape = input_shape[0]
+        dims = input_shape['dim']
+    else:
+        dims = props['input_dim'][:4]
+    return [int(dim) for dim in dims]
+
+def set_input_dims(props, dims):
+    """Replace the dims of the first network input, see input_dims."""
+    dims = [str(dim) for dim in dims]
+    if 'input_shape' in props:
+        input_shape = props['input_shape']
+        if type(input_shape) == list:
+            input_shape = input_shape[0]
+        input_shape['dim'] = dims
+    else:
+        props['input_dim'][:4] = dims
+
+def as_tuple(value):
+    """A field given once holds its value, a repeated one the list."""
+    if value is None:
+        return ()
+    return tuple(value) if type(value) == list else (value,)
+
+def to_bool(value):
+    return value == 'true'
+
+def repeated(convert):
+    def convert_all(value):
+        return tuple(convert(v) for v in as_tuple(value))
+    return convert_all
+
+REQUIRED = object()
+
+class LayerSpec(object):
+    """Typed form of a layer of net_info, decoded once so that building and
+    running the network does not go back to the strings.
+
+    Subclasses name the param block of their layer type and list their
+    fields in schema as (attribute, key, convert, default); a key may be a
+    dotted path into nested blocks or a tuple of keys tried in order.
+    bottom and top are always tuples of blob names.
+    """
+    __slots__ = ('name', 'type', 'bottom', 'top')
+    param = None
+    schema = ()
+
+    def __init__(self, layer):
+        self.name = layer['name']
+        self.type = layer['type']
+        self.bottom = as_tuple(layer.get('bottom'))
+        self.top = as_tuple(layer.get('top'))
+        block = layer.get(self.param, {}) if self.param else {}
+        for attr, keys, convert, default in self.schema:
+            value = default
+            for key in (keys if type(keys) == tuple else (keys,)):
+                raw = block
+                for part in key.split('.'):
+                    raw = raw.get(part) if isinstance(raw, dict) else None
+                if raw is not None:
+                    value = convert(raw)
+                    break
+            if value is REQUIRED:
+                raise ValueError('layer %s: %s needs %s.%s' % (self.name, self.type, self.param, keys))
+            setattr(self, attr, value)
+
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.fields())
+
+    def __setstate__(self, state):
+        for attr, value in zip(self.fields(), state):
+            setattr(self, attr, value)
+
+    @classmethod
+    def fields(cls):
+        return LayerSpec.__slots__ + tuple(entry[0] for entry in cls.schema)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%r' % (attr, getattr(self, attr)) for attr in self.fields()))
+
+class ConvolutionSpec(LayerSpec):
+    param = 'convolution_param'
+    schema = (('num_output', 'num_output', int, REQUIRED),
+              ('kernel_size', 'kernel_size', int, REQUIRED),
+              ('stride', 'stride', int, 1),
+              ('pad', 'pad', int, 0),
+              ('group', 'group', int, 1),
+              ('bias_term', 'bias_term', to_bool, True))
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class BatchNormSpec(LayerSpec):
+    param = 'batch_norm_param'
+    schema = (('moving_average_fraction', 'moving_average_fraction', float, 0.9),
+              ('use_global_stats', 'use_global_stats', to_bool, None),
+              ('eps', 'eps', float, 1e-5))
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class ScaleSpec(LayerSpec):
+    param = 'scale_param'
+    schema = (('axis', 'axis', int, 1),
+              ('num_axes', 'num_axes', int, 1),
+              ('bias_term', 'bias_term', to_bool, False))
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class ReLUSpec(LayerSpec):
+    param = 'relu_param'
+    schema = (('negative_slope', 'negative_slope', float, None),)
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class PoolingSpec(LayerSpec):
+    param = 'pooling_param'
+    schema = (('pool', 'pool', str, 'MAX'),
+              ('kernel_size', 'kernel_size', int, REQUIRED),
+              ('stride', 'stride', int, 1),
+              ('pad', 'pad', int, 0))
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class EltwiseSpec(LayerSpec):
+    param = 'eltwise_param'
+    schema = (('operation', 'operation', str, 'SUM'),
+              ('coeff', 'coeff', repeated(float), None))
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class InnerProductSpec(LayerSpec):
+    param = 'inner_product_param'
+    schema = (('num_output', 'num_output', int, REQUIRED),
+              ('bias_term', 'bias_term', to_bool, True))
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class DropoutSpec(LayerSpec):
+    param = 'dropout_param'
+    schema = (('dropout_ratio', 'dropout_ratio', float, 0.5),)
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class NormalizeSpec(LayerSpec):
+    param = 'norm_param'
+    schema = (('scale', 'scale_filler.value', float, REQUIRED),)
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class LRNSpec(LayerSpec):
+    param = 'lrn_param'
+    schema = (('local_size', 'local_size', int, 5),
+              ('alpha', 'alpha', float, 1.0),
+              ('beta', 'beta', float, 0.75),
+              ('k', 'k', float, 1.0),
+              ('norm_region', 'norm_region', str, 'ACROSS_CHANNELS'))
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class PermuteSpec(LayerSpec):
+    param = 'permute_param'
+    schema = (('order', 'order', repeated(int), REQUIRED),)
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class FlattenSpec(LayerSpec):
+    param = 'flatten_param'
+    schema = (('axis', 'axis', int, 1),)
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class SliceSpec(LayerSpec):
+    param = 'slice_param'
+    schema = (('axis', ('axis', 'slice_dim'), int, 1),
+              ('slice_point', 'slice_point', repeated(int), ()))
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class ConcatSpec(LayerSpec):
+    param = 'concat_param'
+    schema = (('axis', ('axis', 'concat_dim'), int, 1),)
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class PriorBoxSpec(LayerSpec):
+    param = 'prior_box_param'
+    schema = (('min_size', 'min_size', repeated(float), ()),
+              ('max_size', 'max_size', repeated(float), ()),
+              ('aspect_ratio', 'aspect_ratio', repeated(float), ()),
+              ('flip', 'flip', to_bool, True),
+              ('clip', 'clip', to_bool, False),
+              ('variance', 'variance', repeated(float), (0.1,)),
+              ('img_h', ('img_h', 'img_size'), int, 0),
+              ('img_w', ('img_w', 'img_size'), int, 0),
+              ('step_h', ('step_h', 'step'), float, 0.0),
+              ('step_w', ('step_w', 'step'), float, 0.0),
+              ('offset', 'offset', float, 0.5))
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class ReshapeSpec(LayerSpec):
+    param = 'reshape_param'
+    schema = (('dims', 'shape.dim', repeated(int), REQUIRED),)
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class SoftmaxSpec(LayerSpec):
+    param = 'softmax_param'
+    schema = (('axis', 'axis', int, 1),)
+    __slots__ = tuple(entry[0] for entry in schema)
+
+class DetectionOutputSpec(LayerSpec):
+    param = 'detection_output_param'
+    schema = (('num_classes', 'num_classes', int, REQUIRED),
+              ('background_label_id', 'background_label_id', int, 0),
+              ('nms_threshold', 'nms_param.nms_threshold', float, 0.3),
+              ('top_k', 'nms_param.top_k', int, -1),
+              ('keep_top_k', 'keep_top_k', int, -1),
+              # like caffe, no threshold when the field is missing
+              ('confidence_threshold', 'confidence_threshold', float, -float('inf')))
+    __slots__ = tuple(entry[0] for entry in schema)
+
+# spec class by layer type, other types keep name, type, bottom and top only
+LAYER_SPECS = {
+    'Convolution': ConvolutionSpec,
+    'BatchNorm': BatchNormSpec,
+    'Scale': ScaleSpec,
+    'ReLU': ReLUSpec,
+    'Pooling': PoolingSpec,
+    'Eltwise': EltwiseSpec,
+    'InnerProduct': InnerProductSpec,
+    'Dropout': DropoutSpec,
+    'Normalize': NormalizeSpec,
+    'LRN': LRNSpec,
+    'Permute': PermuteSpec,
+    'Flatten': FlattenSpec,
+    'Slice': SliceSpec,
+    'Concat': ConcatSpec,
+    'PriorBox': PriorBoxSpec,
+    'Reshape': ReshapeSpec,
+    'Softmax': SoftmaxSpec,
+    'DetectionOutput': DetectionOutputSpec,
+}
+
+def decode_layers(net_info):
+    """LayerSpecs of the layers of net_info, in order."""
+    return [LAYER_SPECS.get(layer['type'], LayerSpec)(layer) for layer in net_info['layers']]
+
 def is_number(s):
     try:
         float(s)
@@ -93,82 +487,91 @@ def is_number(s):
     except ValueError:
         return False
 
-def print_prototxt(net_info):
-    # whether add double quote
-    def format_value(value):
-        #str = u'%s' % value
-        #if str.isnumeric():
-        if is_number(value):
-            return value
-        elif value == 'true' or value == 'false' or value == 'MAX' or value == 'SUM' or value == 'AVE':
-            return value
-        else:
-            return '\"%s\"' % value
-
-    def print_block(block_info, prefix, indent):
-        blanks = ''.join([' ']*indent)
-        print('%s%s {' % (blanks, prefix))
-        for key,value in block_info.items():
-            if type(value) == OrderedDict:
-                print_block(value, key, indent+4)
-            elif type(value) == list:
-                for v in value:
-                    print('%s    %s: %s' % (blanks, key, format_value(v)))
-            else:
-                print('%s    %s: %s' % (blanks, key, format_value(value)))
-        print('%s}' % blanks)
-        
-    props = net_info['props']
-    layers = net_info['layers']
-    print('name: \"%s\"' % props['name'])
-    print('input: \"%s\"' % props['input'])
-    print('input_dim: %s' % props['input_dim'][0])
-    print('input_dim: %s' % props['input_dim'][1])
-    print('input_dim: %s' % props['input_dim'][2])
-    print('input_dim: %s' % props['input_dim'][3])
-    print('')
-    for layer in layers:
-        print_block(layer, 'layer', 0)
+# fields of caffe.proto holding strings, any other value that reads as
+# a number, a bool or an upper case enum name is written unquoted
+STRING_FIELDS = set(['name', 'type', 'bottom', 'top', 'input', 'source', 'mean_file', 'module',
+                     'layer', 'param_str', 'label_map_file', 'output_directory',
+                     'output_name_prefix', 'output_format', 'name_size_file', 'snapshot_prefix', 'net'])
+ENUM_RE = re.compile(r'^[A-Z][A-Z0-9_]*$')
 
-def save_prototxt(net_info, protofile, region=True):
-    fp = open(protofile, 'w')
-    # whether add double quote
-    def format_value(value):
-        #str = u'%s' % value
-        #if str.isnumeric():
-        if is_number(value):
-            return value
-        elif value == 'true' or value == 'false' or value == 'MAX' or value == 'SUM' or value == 'AVE':
-            return value
-        else:
-            return '\"%s\"' % value
-
-    def print_block(block_info, prefix, indent):
-        blanks = ''.join([' ']*indent)
-        print >>fp, '%s%s {' % (blanks, prefix)
-        for key,value in block_info.items():
-            if type(value) == OrderedDict:
-                print_block(value, key, indent+4)
-            elif type(value) == list:
-                for v in value:
-                    print >> fp, '%s    %s: %s' % (blanks, key, format_value(v))
+def format_value(key, value):
+    if key not in STRING_FIELDS and (is_number(value) or value == 'true' or value == 'false' or ENUM_RE.match(value)):
+        return value
+    # quoted values were kept as written, escapes included
+    return '"%s"' % value
+
+def format_fields(block, indent):
+    """Lines of the key: value and key { } statements of a block."""
+    blanks = ' ' * indent
+    for key, value in block.items():
+        for v in (value if type(value) == list else [value]):
+            if isinstance(v, dict):
+                yield '%s%s {' % (blanks, key)
+                for line in format_fields(v, indent + 4):
+                    yield line
+                yield '%s}' % blanks
             else:
-                print >> fp, '%s    %s: %s' % (blanks, key, format_value(value))
-        print >> fp, '%s}' % blanks
-        
-    props = net_info['props']
-    layers = net_info['layers']
-    print >> fp, 'name: \"%s\"' % props['name']
-    print >> fp, 'input: \"%s\"' % props['input']
-    print >> fp, 'input_dim: %s' % props['input_dim'][0]
-    print >> fp, 'input_dim: %s' % props['input_dim'][1]
-    print >> fp, 'input_dim: %s' % props['input_dim'][2]
-    print >> fp, 'input_dim: %s' % props['input_dim'][3]
-    print >> fp, ''
-    for layer in layers:
+                yield '%s%s: %s' % (blanks, key, format_value(key, v))
+
+def format_prototxt(net_info, region=True):
+    """Lines of the prototxt of net_info, the network properties (name,
+    inputs, ...) as they were parsed, then the layers."""
+    for line in format_fields(net_info['props'], 0):
+        yield line
+    yield ''
+    for layer in net_info['layers']:
         if layer['type'] != 'Region' or region == True:
-            print_block(layer, 'layer', 0)
-    fp.close()
+            for line in format_fields(OrderedDict([('layer', layer)]), 0):
+                yield line
+
+def print_prototxt(net_info):
+    for line in format_prototxt(net_info):
+        print(line)
+
+def save_prototxt(net_info, protofile, region=True):
+    with open(protofile, 'w') as fp:
+        for line in format_prototxt(net_info, region):
+            fp.write(line + '\n')
+
+def write_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def field_header(field, length):
+    # key and length of a length-delimited field
+    return write_varint(field << 3 | 2) + write_varint(length)
+
+def save_caffemodel(layers, caffemodel):
+    """Write a caffemodel in the protobuf wire format without building
+    protobuf objects. Every blob is written as a packed float field
+    straight from its array buffer.
+    Args:
+        layers: list of (name, type, [arrays]), the arrays are stored as
+            float32 BlobProtos with their shapes.
+    """
+    with open(caffemodel, 'wb') as fp:
+        for name, ltype, arrays in layers:
+            # LayerParameter: name = 1, type = 2, blobs = 7
+            # BlobProto: data = 5 (packed float), shape = 7 (BlobShape: dim = 1, packed int64)
+            chunks = []
+            for array in arrays:
+                data = np.ascontiguousarray(array, dtype='<f4')
+                dims = b''.join(write_varint(dim) for dim in data.shape)
+                shape = field_header(1, len(dims)) + dims
+                header = field_header(7, len(shape)) + shape + field_header(5, data.nbytes)
+                chunks.append(field_header(7, len(header) + data.nbytes) + header)
+                chunks.append(data)
+            name = name.encode('utf-8')
+            ltype = ltype.encode('utf-8')
+            chunks.insert(0, field_header(1, len(name)) + name + field_header(2, len(ltype)) + ltype)
+            # NetParameter: layer = 100
+            fp.write(field_header(100, sum(len(c) if type(c) == bytes else c.nbytes for c in chunks)))
+            for chunk in chunks:
+                fp.write(chunk)
 
 
 if __name__ == '__main__':
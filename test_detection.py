@@ -0,0 +1,74 @@
+# Unit tests of the SSD utilities, run with pytest
+from __future__ import print_function
+import math
+import torch
+from detection import MultiBoxLoss, jaccard, nms, batched_nms
+
+def multibox_loss(negpos_ratio):
+    # 20 disjoint priors in a row, the ground truths are exactly priors
+    # 0-2 of image 0 and 3-6 of image 1, so num_pos is [3, 4]
+    num_priors, num_classes = 20, 3
+    x = torch.arange(num_priors, dtype=torch.float) / num_priors
+    priors = torch.stack([x, torch.zeros(num_priors), x + 0.05, torch.full((num_priors,), 0.05)], 1)
+    priors = torch.stack([priors.view(-1), torch.full((num_priors*4,), 0.1)]).unsqueeze(0)
+    targets = torch.zeros(7, 8)
+    targets[:3, 0] = 0
+    targets[3:, 0] = 1
+    targets[:, 1] = 1
+    targets[:, 3:7] = priors[0, 0].view(-1, 4)[:7]
+    loc = torch.zeros(2, num_priors * 4)
+    # equal logits, every prior costs log(num_classes)
+    conf = torch.zeros(2, num_priors * num_classes)
+    criterion = MultiBoxLoss(num_classes, 0.5, True, 0, True, negpos_ratio, 0.5, use_gpu=False)
+    return criterion(loc, conf, priors, targets).item()
+
+def test_multibox_loss_fractional_negpos_ratio():
+    # caffe floors 2.5 * [3, 4] to 7 + 10 negatives, over 7 positives
+    num_neg = (multibox_loss(2.5) - multibox_loss(0)) * 7 / math.log(3)
+    assert abs(num_neg - 17) < 1e-4
+
+def test_multibox_loss_integer_negpos_ratio():
+    num_neg = (multibox_loss(3) - multibox_loss(0)) * 7 / math.log(3)
+    assert abs(num_neg - 21) < 1e-4
+
+def reference_nms(boxes, order, overlap):
+    # the greedy per-box loop, over candidates in descending score order
+    keep = []
+    for i in order.tolist():
+        if len(keep) == 0 or jaccard(boxes[i:i+1], boxes[keep]).max() <= overlap:
+            keep.append(i)
+    return keep
+
+def random_boxes(num):
+    centers = torch.rand(num, 2)
+    sizes = torch.rand(num, 2) * 0.2 + 0.02
+    # few distinct scores, so that many candidates tie
+    scores = (torch.rand(num) * 20).floor() / 20
+    return torch.cat([centers - sizes / 2, centers + sizes / 2], 1), scores
+
+def test_nms_matches_reference():
+    torch.manual_seed(0)
+    for num, top_k in [(600, -1), (600, 200), (50, 200)]:
+        boxes, scores = random_boxes(num)
+        order = scores.sort(0)[1].flip(0)
+        if top_k > 0:
+            order = order[:top_k]
+        ids, count = nms(boxes, scores, 0.45, top_k)
+        assert ids[:count].tolist() == reference_nms(boxes, order, 0.45)
+
+def test_batched_nms_matches_reference():
+    torch.manual_seed(0)
+    for top_k in [-1, 100]:
+        boxes, scores = random_boxes(600)
+        labels = torch.randint(0, 3, (600,))
+        order = scores.sort(0)[1].flip(0)
+        expected = []
+        for label in range(3):
+            class_order = order[labels[order] == label]
+            if top_k > 0:
+                class_order = class_order[:top_k]
+            expected += reference_nms(boxes, class_order, 0.45)
+        expected = torch.tensor(expected)
+        expected = expected[scores[expected].sort(descending=True, stable=True)[1]]
+        ids, count = batched_nms(boxes, scores, labels, 0.45, top_k)
+        assert ids[:count].tolist() == expected.tolist()
@@ -0,0 +1,129 @@
+# Unit tests of layers and small networks, run with pytest
+from __future__ import print_function
+import torch
+from torch.nn.parameter import Parameter
+from caffenet import CaffeNet
+
+def scale_net(tmpdir, scale_param, bottom2=False):
+    lines = ['input: "data"', 'input_dim: 2', 'input_dim: 3', 'input_dim: 5', 'input_dim: 5']
+    bottoms = 'bottom: "data"'
+    if bottom2:
+        lines += ['layer { name: "pool" type: "Pooling" bottom: "data" top: "pool"',
+                  '        pooling_param { pool: AVE kernel_size: 5 stride: 5 } }']
+        bottoms += ' bottom: "pool"'
+    lines += ['layer { name: "scale" type: "Scale" %s top: "out"' % bottoms,
+              '        scale_param { %s } }' % scale_param]
+    protofile = tmpdir.join('scale.prototxt')
+    protofile.write('\n'.join(lines))
+    net = CaffeNet(str(protofile))
+    net.eval()
+    return net, net.models['scale']
+
+def test_scale_num_axes_0(tmpdir):
+    net, scale = scale_net(tmpdir, 'num_axes: 0 bias_term: true')
+    assert scale.weight.size() == torch.Size([]) and scale.bias.size() == torch.Size([])
+    scale.weight.data.fill_(2)
+    scale.bias.data.fill_(1)
+    x = torch.randn(2, 3, 5, 5)
+    assert torch.allclose(net(x)['out'], x * 2 + 1)
+
+def test_scale_negative_axis(tmpdir):
+    net, scale = scale_net(tmpdir, 'axis: -1 bias_term: true')
+    assert scale.weight.size() == torch.Size([5]) and scale.bias.size() == torch.Size([5])
+    scale.weight.data.copy_(torch.arange(5.))
+    scale.bias.data.fill_(1)
+    x = torch.randn(2, 3, 5, 5)
+    assert torch.allclose(net(x)['out'], x * torch.arange(5.) + 1)
+
+def test_scale_bottom_bias(tmpdir):
+    net, scale = scale_net(tmpdir, 'axis: 0 bias_term: true', bottom2=True)
+    # like caffe the bias has the shape of the second bottom, batch included
+    assert scale.weight is None and scale.bias.size() == torch.Size([2, 3, 1, 1])
+    scale.bias.data.copy_(torch.arange(6.).view(2, 3, 1, 1))
+    x = torch.randn(2, 3, 5, 5)
+    pool = x.mean(3, keepdim=True).mean(2, keepdim=True)
+    expected = x * pool + torch.arange(6.).view(2, 3, 1, 1)
+    assert torch.allclose(net(x)['out'], expected)
+
+def conv_bn_net(tmpdir, bias_term):
+    lines = ['input: "data"', 'input_dim: 2', 'input_dim: 3', 'input_dim: 8', 'input_dim: 8',
+             'layer { name: "conv1" type: "Convolution" bottom: "data" top: "c1"',
+             '        convolution_param { num_output: 4 kernel_size: 3 pad: 1 bias_term: %s } }' % bias_term,
+             'layer { name: "bn1" type: "BatchNorm" bottom: "c1" top: "b1" }',
+             'layer { name: "scale1" type: "Scale" bottom: "b1" top: "s1" scale_param { bias_term: true } }',
+             'layer { name: "relu1" type: "ReLU" bottom: "s1" top: "s1" }',
+             'layer { name: "conv2" type: "Convolution" bottom: "s1" top: "out"',
+             '        convolution_param { num_output: 2 kernel_size: 1 } }']
+    protofile = tmpdir.join('conv_bn.prototxt')
+    protofile.write('\n'.join(lines))
+    net = CaffeNet(str(protofile))
+    torch.manual_seed(0)
+    for module in net.models.values():
+        for param in module.parameters():
+            param.data.uniform_(-1, 1)
+    net.models['bn1'].running_mean.uniform_(-1, 1)
+    net.models['bn1'].running_var.uniform_(0.5, 2)
+    net.eval()
+    return net
+
+def test_optimize_for_inference(tmpdir):
+    for bias_term in ['true', 'false']:
+        net = conv_bn_net(tmpdir, bias_term)
+        x = torch.randn(2, 3, 8, 8)
+        with torch.no_grad():
+            expected = net(x)['out'].clone()
+            assert net.optimize_for_inference() == ['conv1']
+            assert [layer.name for layer in net.layer_specs] == ['conv1', 'relu1', 'conv2']
+            assert torch.allclose(net(x)['out'], expected, atol=1e-5)
+
+def test_optimize_for_inference_outputs(tmpdir):
+    # a selected intermediate blob must survive the folding
+    for bias_term in ['true', 'false']:
+        net = conv_bn_net(tmpdir, bias_term)
+        net.set_outputs(['b1', 'out'])
+        x = torch.randn(2, 3, 8, 8)
+        with torch.no_grad():
+            expected = dict((name, blob.clone()) for name, blob in net(x).items())
+            assert net.optimize_for_inference() == ['conv1']
+            assert net.output_names == ['b1', 'out']
+            assert 'scale1' in net.models
+            blobs = net(x)
+            for name in ['b1', 'out']:
+                assert torch.allclose(blobs[name], expected[name], atol=1e-5)
+            assert torch.allclose(net(x, outputs=['b1'])['b1'], expected['b1'], atol=1e-5)
+
+def assert_same_after_reload(tmpdir, net, x):
+    protofile = str(tmpdir.join('saved.prototxt'))
+    caffemodel = str(tmpdir.join('saved.caffemodel'))
+    net.save_model(protofile, caffemodel)
+    saved = CaffeNet(protofile)
+    saved.load_weights(caffemodel)
+    saved.eval()
+    with torch.no_grad():
+        assert torch.allclose(saved(x)['out'], net(x)['out'], atol=1e-5)
+    return saved
+
+def test_save_model(tmpdir):
+    for bias_term in ['true', 'false']:
+        net = conv_bn_net(tmpdir, bias_term)
+        assert_same_after_reload(tmpdir, net, torch.randn(2, 3, 8, 8))
+        net.optimize_for_inference()
+        assert_same_after_reload(tmpdir, net, torch.randn(2, 3, 8, 8))
+
+def test_save_model_pruned(tmpdir):
+    # drop channels 1 and 3 of conv1, the layers after it follow
+    net = conv_bn_net(tmpdir, 'true')
+    keep = torch.tensor([0, 2])
+    conv1, bn1, scale1, conv2 = [net.models[name] for name in ['conv1', 'bn1', 'scale1', 'conv2']]
+    conv1.weight = Parameter(conv1.weight.data[keep])
+    conv1.bias = Parameter(conv1.bias.data[keep])
+    conv1.out_channels = 2
+    bn1.running_mean = bn1.running_mean[keep]
+    bn1.running_var = bn1.running_var[keep]
+    bn1.num_features = 2
+    scale1.weight = Parameter(scale1.weight.data[keep])
+    scale1.bias = Parameter(scale1.bias.data[keep])
+    conv2.weight = Parameter(conv2.weight.data[:, keep])
+    conv2.in_channels = 2
+    saved = assert_same_after_reload(tmpdir, net, torch.randn(2, 3, 8, 8))
+    assert saved.models['conv1'].out_channels == 2 and saved.models['bn1'].num_features == 2